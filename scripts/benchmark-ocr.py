@@ -0,0 +1,74 @@
+import argparse
+import os
+import time
+
+# time a single tesseract instance, so runs are comparable across machines
+os.environ.setdefault('OCR_WORKERS', '1')
+from shipt import receipts
+from shipt import ocr
+# downloads the test images into tests/images, so needs TEST_BUCKET_NAME
+from tests.test_receipts import parsed_data
+
+IMAGES = "tests/images"
+
+
+def run(path, scale):
+    """OCRs and parses one image at `scale` (None to pick one), skipping the
+    OCR cache. Returns (seconds, parsed records).
+    """
+    start = time.time()
+    gray = receipts.preprocess(path, scale=scale)
+    text = ocr.get_engine().image_to_string(gray)
+    elapsed = time.time() - start
+    try:
+        records = receipts.text_to_df(text, path).to_dict(orient='records')
+    except KeyError:
+        records = []
+    return elapsed, records
+
+
+def score(records, expected):
+    """number of expected fields that were parsed correctly, out of how many.
+    """
+    n_right, n = 0, 0
+    for n_shop, shop in enumerate(expected):
+        for k, v in shop.items():
+            n += 1
+            if n_shop < len(records) and records[n_shop].get(k) == v:
+                n_right += 1
+    return n_right, n
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="compare OCR latency and accuracy of fixed and adaptive upscaling on the test receipts")
+    parser.add_argument("--scales", default="2,auto",
+                        help="comma-separated scales to try, 'auto' for adaptive (default: 2,auto)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="times to OCR each image, taking the fastest")
+    args = parser.parse_args()
+
+    ocr.get_engine()
+    results = []
+    for label in args.scales.split(","):
+        scale = None if label == "auto" else float(label)
+        total_time, total_right, total = 0, 0, 0
+        for fname in sorted(parsed_data):
+            path = os.path.join(IMAGES, fname)
+            if not os.path.exists(path):
+                print("> Missing test image:", path)
+                continue
+            runs = [run(path, scale) for _ in range(args.repeat)]
+            elapsed = min(t for t, _ in runs)
+            n_right, n = score(runs[0][1], parsed_data[fname])
+            print("> {:>5} {:<28} {:7.0f}ms  {}/{} fields".format(
+                label, fname, elapsed * 1000, n_right, n))
+            total_time += elapsed
+            total_right += n_right
+            total += n
+        results.append((label, total_time, total_right, total))
+
+    print()
+    print("{:>5} {:>10} {:>10}".format("scale", "time", "accuracy"))
+    for label, total_time, total_right, total in results:
+        print("{:>5} {:9.2f}s {:10.1%}".format(label, total_time, total_right / max(total, 1)))
@@ -1,30 +1,92 @@
 from google.cloud import storage
-import shipt
+from shipt import shipt_backend
+from shipt import export
+from shipt import mirror
 from datetime import datetime
 import pandas as pd
+import argparse
+import json
 import os
 
-BUCKET_NAME = os.environ['BUCKET_NAME']
-SB = shipt.shipt_backend.FirestoreBackend()
+BUCKET_NAME = os.environ.get('BUCKET_NAME')
+SB = shipt_backend.FirestoreBackend()
+WATERMARK_PATH = os.path.join("export", "watermark.json")
+
+
+def read_watermarks():
+    if not os.path.exists(WATERMARK_PATH):
+        return {}
+    with open(WATERMARK_PATH) as f:
+        return {k: pd.Timestamp(v).to_pydatetime() for k, v in json.load(f).items()}
+
+
+def write_watermarks(watermarks):
+    with open(WATERMARK_PATH, 'w') as f:
+        json.dump({k: v.isoformat() for k, v in watermarks.items()}, f)
+
+
+def tracking_latest(pages, field, latest):
+    """passes pages through, keeping the latest `field` timestamp seen in `latest`
+    """
+    for page in pages:
+        for r in page:
+            if r.get(field) is not None and (latest.get(field) is None or
+                                             r[field] > latest[field]):
+                latest[field] = r[field]
+        yield page
+
+
 if __name__ == "__main__":
-    # download all images
-    storage_client = storage.Client()
-    blobs = storage_client.list_blobs(BUCKET_NAME)
-    images = [b for b in blobs if '.csv' not in b.name]
+    parser = argparse.ArgumentParser(description="download all images and parsed data")
+    parser.add_argument("--format", choices=export.FORMATS, default="csv",
+                        help="file format for the parsed data")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only export shops and phones added or changed since the last "
+                        "incremental export, appending a new part to export/shops and export/phones")
+    parser.add_argument("--workers", type=int, default=8,
+                        help="number of images to download at once")
+    parser.add_argument("--local-bucket", default=None,
+                        help="mirror from this directory instead of the cloud storage bucket")
+    args = parser.parse_args()
+
+    # mirror all images, skipping ones we already have
+    if args.local_bucket is not None:
+        blobs = mirror.LocalBucket(args.local_bucket).list_blobs()
+    else:
+        storage_client = storage.Client()
+        blobs = storage_client.list_blobs(BUCKET_NAME)
+    images = (b for b in blobs if '.csv' not in b.name)
     print("> Downloading images...")
-    os.makedirs("export/images", exist_ok=True)
-    for i in images:
-        print(i.name)
-        i.download_to_filename(os.path.join("export/images", i.name))
-
-    print("> Downloading parsed data...")
-    df_all = SB.get_all_shops()
-    df_phones = pd.DataFrame(SB.get_all_phones())
-    fname = "shipt_all_shops_{}.csv".format(datetime.now().strftime("%m-%d-%Y"))
-    phonename = "shipt_all_phones_{}.csv".format(
-        datetime.now().strftime("%m-%d-%Y"))
-    fpath = os.path.join("export", fname)
-    phonepath = os.path.join("export", phonename)
-    print("> Saving dataframes...")
-    df_all.to_csv(fpath)
-    df_phones.to_csv(phonepath)
+    counts = mirror.mirror_blobs(images, "export/images", workers=args.workers)
+    print("> Downloaded {downloaded} images, skipped {skipped}, {failed} failed".format(**counts))
+
+    if args.incremental:
+        print("> Downloading new and changed parsed data...")
+        watermarks = read_watermarks()
+        latest = dict(watermarks)
+        part = "part-{}.{}".format(datetime.now().strftime("%Y%m%d%H%M%S"), args.format)
+        for name, pages, field, schema in [
+                ('shops', SB.iter_shop_pages(since=watermarks.get('ingested_at')),
+                 'ingested_at', export.SHOP_SCHEMA),
+                ('phones', SB.iter_phone_pages(since=watermarks.get('updated_at')),
+                 'updated_at', export.PHONE_SCHEMA)]:
+            os.makedirs(os.path.join("export", name), exist_ok=True)
+            fpath = os.path.join("export", name, part)
+            n = export.write_pages(tracking_latest(pages, field, latest), fpath,
+                                   schema, args.format)
+            if n == 0:
+                os.remove(fpath)
+            print("> Saved {} new or changed {}".format(n, name))
+        write_watermarks(latest)
+    else:
+        print("> Downloading parsed data...")
+        df_all = SB.get_all_shops()
+        df_phones = pd.DataFrame(SB.get_all_phones())
+        fname = "shipt_all_shops_{}.{}".format(datetime.now().strftime("%m-%d-%Y"), args.format)
+        phonename = "shipt_all_phones_{}.{}".format(
+            datetime.now().strftime("%m-%d-%Y"), args.format)
+        fpath = os.path.join("export", fname)
+        phonepath = os.path.join("export", phonename)
+        print("> Saving dataframes...")
+        export.write_dataframe(df_all, fpath, args.format, export.SHOP_SCHEMA)
+        export.write_dataframe(df_phones, phonepath, args.format, export.PHONE_SCHEMA)
@@ -0,0 +1,20 @@
+from shipt import shipt_backend
+import argparse
+import os
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="file every phone that has a metro into the metro index, and rebuild each metro's running totals")
+    parser.add_argument("--prefix", default=None,
+                        help="collection prefix, e.g. 'test_' (defaults to '' in production, 'test_' otherwise)")
+    args = parser.parse_args()
+    prefix = args.prefix
+    if prefix is None:
+        prefix = '' if os.environ.get('CONFIG') == 'production' else 'test_'
+
+    SB = shipt_backend.FirestoreBackend(prefix=prefix)
+    print("> Filing phones into the metro index...")
+    SB.rebuild_metro_index()
+    print("> Rebuilding metro totals...")
+    SB.rebuild_metro_aggregates()
+    print("> Done.")
@@ -0,0 +1,97 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+import pandas as pd
+
+# each process gets a single tesseract instance; the parallelism comes from
+# the process pool
+os.environ.setdefault('OCR_WORKERS', '1')
+from shipt import receipts
+from shipt import export
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+PAGE_SIZE = 1000
+
+
+def find_images(directory):
+    images = []
+    for dirpath, _, filenames in os.walk(directory):
+        for fname in filenames:
+            if fname.lower().endswith(IMAGE_EXTENSIONS):
+                images.append(os.path.join(dirpath, fname))
+    return sorted(images)
+
+
+def parse_image(path):
+    """parses one image, returning (path, records, error). Runs in a worker
+    process. The records aren't reconciled yet; see `finish_page`.
+    """
+    try:
+        df = receipts.receipt_to_df(path, reconciled=False)
+        return path, df.to_dict(orient='records'), None
+    except Exception as e:
+        return path, [], "{}: {}".format(type(e).__name__, e)
+
+
+def finish_page(records, stats):
+    """reconciles a page of parsed records in one pass (see receipts.finish_shops).
+    """
+    records = receipts.finish_shops(pd.DataFrame(records)).to_dict(orient='records')
+    stats['n_shops'] += len(records)
+    return records
+
+
+def result_pages(results, errors, stats):
+    """groups parsed records into reconciled pages for export.write_pages,
+    collecting errors and counts as they stream past.
+    """
+    page = []
+    for path, records, error in results:
+        stats['n_images'] += 1
+        if error is not None:
+            errors.append({'filename': path, 'error': error})
+        elif len(records) == 0:
+            stats['n_empty'] += 1
+        page.extend(records)
+        if len(page) >= PAGE_SIZE:
+            yield finish_page(page, stats)
+            page = []
+        if stats['n_images'] % 100 == 0:
+            print("> {} images parsed...".format(stats['n_images']))
+    if len(page) > 0:
+        yield finish_page(page, stats)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="re-run receipt parsing over a directory of screenshots, e.g. export/images")
+    parser.add_argument("images", help="directory of images")
+    parser.add_argument("output", help="output table, e.g. reparsed.csv or reparsed.parquet")
+    parser.add_argument("--format", choices=export.FORMATS, default=None,
+                        help="output format (defaults to the output file's extension)")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(),
+                        help="number of worker processes")
+    args = parser.parse_args()
+    fmt = args.format or ('parquet' if args.output.endswith('.parquet') else 'csv')
+
+    images = find_images(args.images)
+    print("> Parsing {} images with {} processes...".format(len(images), args.processes))
+    errors = []
+    stats = {'n_images': 0, 'n_empty': 0, 'n_shops': 0}
+    start = time.time()
+    with Pool(processes=args.processes) as pool:
+        results = pool.imap_unordered(parse_image, images, chunksize=4)
+        export.write_pages(result_pages(results, errors, stats), args.output,
+                           export.SHOP_SCHEMA, fmt)
+    elapsed = time.time() - start
+
+    if len(errors) > 0:
+        errors_path = os.path.splitext(args.output)[0] + ".errors.csv"
+        pd.DataFrame(errors).to_csv(errors_path, index=False)
+        print("> Wrote {} errors to {}".format(len(errors), errors_path))
+    n = max(stats['n_images'], 1)
+    print("> Parsed {} shops from {} images in {:.1f}s ({:.2f} images/s)".format(
+        stats['n_shops'], stats['n_images'], elapsed, stats['n_images'] / max(elapsed, 1e-9)))
+    print("> Failure rate: {:.1%} errors, {:.1%} with no shops found".format(
+        len(errors) / n, stats['n_empty'] / n))
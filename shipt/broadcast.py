@@ -0,0 +1,94 @@
+import os
+import time
+import hashlib
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# messages per second to send a broadcast at. Twilio queues anything over a
+# number's limit (1/s for a long code), so this keeps a broadcast within it.
+RATE = float(os.environ.get('BROADCAST_RATE', 1))
+# concurrent sends, so a slow API call doesn't hold up the rest
+WORKERS = int(os.environ.get('BROADCAST_WORKERS', 4))
+
+
+class RateLimiter():
+    """token bucket allowing `rate` calls to `acquire` per second, shared
+    between threads.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """blocks until a call is allowed.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def broadcast_id(message, day=None):
+    """id for a broadcast of `message`: the same message sent again on the same
+    day is the same broadcast, so it's only sent to each number once.
+    """
+    day = day or datetime.now().strftime("%Y-%m-%d")
+    return hashlib.sha256("{}:{}".format(day, message).encode('utf-8')).hexdigest()[:16]
+
+
+def run_broadcast(backend, broadcast_id, message, numbers, send,
+                  rate=RATE, workers=WORKERS):
+    """sends `message` to each of `numbers` with `send(number, message)`,
+    at most `rate` a second across `workers` threads.
+
+    Each number is marked 'sending' in `backend` before it's sent, then 'sent'
+    or 'failed' (see FirestoreBackend.set_broadcast_status). Numbers marked
+    sending or sent are skipped, so re-running a broadcast that was cut off
+    finishes it without texting anyone twice. Delivery is at most once: a
+    number whose send was cut off midway stays 'sending' and isn't retried.
+    Only one instance should run a broadcast at a time (see
+    FirestoreBackend.start_broadcast).
+    Returns counts of sent, skipped and failed numbers, and how long it took.
+    """
+    start = time.time()
+    already_sent = backend.get_broadcast_handled(broadcast_id)
+    to_send = [n for n in dict.fromkeys(numbers) if n not in already_sent]
+    limiter = RateLimiter(rate)
+    counts = {'sent': 0, 'skipped': len(set(numbers)) - len(to_send), 'failed': 0}
+    lock = threading.Lock()
+    print("Broadcasting to {} numbers ({} already sent) at {}/s...".format(
+        len(to_send), counts['skipped'], rate))
+
+    def send_one(number):
+        limiter.acquire()
+        backend.set_broadcast_status(broadcast_id, number, 'sending')
+        try:
+            send(number, message)
+        except Exception as e:
+            print("Error sending broadcast to {}: {}".format(number, e))
+            backend.set_broadcast_status(broadcast_id, number, 'failed', str(e))
+            with lock:
+                counts['failed'] += 1
+            return
+        backend.set_broadcast_status(broadcast_id, number, 'sent')
+        with lock:
+            counts['sent'] += 1
+            if counts['sent'] % 100 == 0:
+                print("> {} broadcast messages sent...".format(counts['sent']))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(send_one, to_send))
+    counts['seconds'] = time.time() - start
+    return counts
@@ -0,0 +1,132 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError
+
+# seconds to remember the reply to a message, so a twilio retry of it gets the
+# same reply without being handled again. Off (0) outside production by
+# default, since the tests reuse message SIDs.
+TTL = float(os.environ.get('MESSAGE_DEDUPE_TTL',
+                           600 if os.environ.get('CONFIG') == 'production' else 0))
+MAX_REPLIES = int(os.environ.get('MESSAGE_DEDUPE_ENTRIES', 10000))
+# set to 1 to also share replies between instances through the backend
+SHARED = os.environ.get('MESSAGE_DEDUPE_SHARED', '0') == '1'
+# seconds a retry waits for the first attempt at a message to finish, before
+# getting an empty reply
+WAIT = float(os.environ.get('MESSAGE_DEDUPE_WAIT', 10))
+# seconds an instance's claim on a message lasts, in case it goes away
+# without replying
+CLAIM_TIMEOUT = 60
+
+
+class ReplyCache():
+    """remembers the rendered reply to each recent message SID for `ttl` seconds.
+
+    A message is claimed (see `claim`) before it's handled, so a retry that
+    arrives while the first attempt is still running waits for its reply
+    instead of handling the message again.
+
+    Holds at most `max_entries` replies in memory. With a `backend` (see
+    FirestoreBackend.claim_message), claims and replies are also saved there,
+    so a retry that lands on another instance is caught too.
+    """
+
+    def __init__(self, ttl=TTL, max_entries=MAX_REPLIES, backend=None, wait=WAIT):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self.wait = wait
+        self.replies = OrderedDict()
+        # message SID -> future of its reply, for messages being handled here
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def _expire(self, now):
+        while len(self.replies) > 0:
+            expires, _ = next(iter(self.replies.values()))
+            if expires > now and len(self.replies) <= self.max_entries:
+                break
+            self.replies.popitem(last=False)
+
+    def get(self, message_sid):
+        """the saved reply to a message, or None.
+        """
+        if not self.enabled or message_sid is None:
+            return None
+        now = time.time()
+        with self.lock:
+            self._expire(now)
+            if message_sid in self.replies:
+                return self.replies[message_sid][1]
+        if self.backend is not None:
+            return self.backend.get_message_reply(message_sid)
+        return None
+
+    def claim(self, message_sid):
+        """claims a message for the caller to handle. Returns (claimed, reply).
+
+        If the message was already replied to, or is being handled by someone
+        else, claimed is False and reply is that reply: waited on for up to
+        `wait` seconds if it's being handled here, or None if it isn't ready.
+        Once claimed, call `set` with the reply, or `release` on failure.
+        """
+        if not self.enabled or message_sid is None:
+            return True, None
+        with self.lock:
+            self._expire(time.time())
+            if message_sid in self.replies:
+                return False, self.replies[message_sid][1]
+            pending = self.pending.get(message_sid)
+            if pending is None:
+                self.pending[message_sid] = Future()
+        if pending is not None:
+            try:
+                return False, pending.result(timeout=self.wait)
+            except TimeoutError:
+                return False, None
+        if self.backend is not None:
+            try:
+                reply = self.backend.claim_message(message_sid, CLAIM_TIMEOUT)
+            except Exception:
+                self._resolve(message_sid, None)
+                raise
+            if reply is not None:
+                # replied to, or being handled, on another instance
+                self._resolve(message_sid, reply or None)
+                return False, reply or None
+        return True, None
+
+    def _resolve(self, message_sid, response):
+        with self.lock:
+            pending = self.pending.pop(message_sid, None)
+        if pending is not None:
+            pending.set_result(response)
+
+    def release(self, message_sid):
+        """gives up a claim on a message that couldn't be handled, so a retry of
+        it is handled again.
+        """
+        if not self.enabled or message_sid is None:
+            return
+        self._resolve(message_sid, None)
+        if self.backend is not None:
+            self.backend.release_message(message_sid)
+
+    def set(self, message_sid, response):
+        """saves the reply to a message, and hands it to any retries waiting on it.
+        """
+        if not self.enabled or message_sid is None:
+            return
+        now = time.time()
+        with self.lock:
+            self.replies[message_sid] = (now + self.ttl, response)
+            self.replies.move_to_end(message_sid)
+            self._expire(now)
+        self._resolve(message_sid, response)
+        if self.backend is not None:
+            self.backend.set_message_reply(message_sid, response, self.ttl)
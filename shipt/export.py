@@ -1,22 +1,169 @@
-import requests
 import os.path
+import json
 import pandas as pd
-from datetime import datetime, timedelta
-from . import receipts
-from . import shipt_backend
+import pyarrow as pa
+import pyarrow.parquet as pq
+from datetime import datetime, timedelta, timezone
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
 
-KEY = os.environ['SECRET_KEY']
-s = Serializer(KEY, 60*30) # 60 secs by 30 mins
+# export links are good for 30 minutes
+TOKEN_SECONDS = 60*30
 
-def write_and_get_signed_path(phone, key, dataframe, uploads_path):
+FORMATS = ['csv', 'parquet']
+
+# explicit schemas for exports. These fix the columns of streamed exports
+# (the header is written before we've seen every record), and the types of
+# parquet exports, so readers don't have to re-infer them.
+SHOP_SCHEMA = pa.schema([
+    ('order_number', pa.string()),
+    ('order_total', pa.float64()),
+    ('late', pa.bool_()),
+    ('delivery_only', pa.bool_()),
+    ('delivery_window_start', pa.string()),
+    ('delivery_window_end', pa.string()),
+    ('delivery_date', pa.string()),
+    ('delivered_date', pa.string()),
+    ('delivered_time', pa.string()),
+    ('order_pay', pa.float64()),
+    ('tip', pa.float64()),
+    ('promo_pay', pa.float64()),
+    ('total_pay', pa.float64()),
+    # tesseract's confidence (0-100) in each amount
+    ('order_total_conf', pa.float64()),
+    ('order_pay_conf', pa.float64()),
+    ('tip_conf', pa.float64()),
+    ('promo_pay_conf', pa.float64()),
+    ('total_pay_conf', pa.float64()),
+    ('filename', pa.string()),
+    ('media_url', pa.string()),
+    ('date_submitted', pa.string()),
+    ('phone', pa.string()),
+    ('from_zip', pa.string()),
+    ('is_v1', pa.bool_()),
+    ('ingested_at', pa.timestamp('us', tz='UTC')),
+])
+PHONE_SCHEMA = pa.schema([
+    ('phone', pa.string()),
+    ('metro', pa.string()),
+    ('metro_key', pa.string()),
+    # stored as a JSON string
+    ('session', pa.string()),
+    ('updated_at', pa.timestamp('us', tz='UTC')),
+])
+SHOP_COLUMNS = SHOP_SCHEMA.names
+PHONE_COLUMNS = PHONE_SCHEMA.names
+
+
+def parse_format(text):
+    """picks an export format out of a command, e.g. 'export parquet'
+    """
+    return 'parquet' if 'parquet' in text.lower() else 'csv'
+
+
+def parse_since(text):
+    """picks an optional 'since=YYYY-MM-DD' watermark out of a command, as a
+    UTC datetime. Returns None if there isn't one.
+    """
+    for part in text.replace(":", " ").split():
+        if part.startswith("since="):
+            since = datetime.strptime(part[len("since="):], "%Y-%m-%d")
+            return since.replace(tzinfo=timezone.utc)
+    return None
+
+
+def signed_filename(token, fmt='csv'):
+    return "{}.{}".format(token, fmt)
+
+
+def serializer():
+    """signs export tokens. SECRET_KEY is only read here, so scripts can use
+    this module without it.
+    """
+    return Serializer(os.environ['SECRET_KEY'], TOKEN_SECONDS)
+
+
+def get_token(phone, key, fmt='csv'):
+    return serializer().dumps({'phone': phone, 'key': key, 'fmt': fmt}).decode('utf-8')
+
+
+def to_schema(df, schema):
+    """coerces a dataframe of records to the columns and types of `schema`.
+
+    Anything that doesn't fit a column's type (e.g. the empty strings that
+    receipts.receipt_to_df fills in) becomes null.
+    """
+    out = pd.DataFrame(index=df.index)
+    for field in schema:
+        col = df[field.name] if field.name in df else pd.Series(None, index=df.index, dtype=object)
+        if pa.types.is_floating(field.type):
+            out[field.name] = pd.to_numeric(col, errors='coerce')
+        elif pa.types.is_timestamp(field.type):
+            out[field.name] = pd.to_datetime(col, utc=True, errors='coerce')
+        elif pa.types.is_boolean(field.type):
+            out[field.name] = col.map(lambda x: x if isinstance(x, bool) else None).astype(object)
+        else:
+            out[field.name] = col.map(
+                lambda x: None if x is None or (isinstance(x, float) and x != x)
+                else json.dumps(x) if isinstance(x, dict) else str(x)).astype(object)
+    return out
+
+
+def to_table(df, schema):
+    return pa.Table.from_pandas(to_schema(df, schema), schema=schema,
+                                preserve_index=False)
+
+
+def write_dataframe(df, fpath, fmt='csv', schema=None):
+    """writes a dataframe as csv, or as zstd-compressed parquet with `schema`.
+    """
+    if fmt == 'parquet':
+        pq.write_table(to_table(df, schema), fpath, compression='zstd')
+    else:
+        df.to_csv(fpath)
+
+
+def write_and_get_signed_path(phone, key, dataframe, uploads_path, fmt='csv',
+                              schema=SHOP_SCHEMA):
     """write a file to a path using an itsdangerous timed token
     """
-    token = s.dumps({'phone': phone, 'key': key}).decode('utf-8')
-    fname = "{}.csv".format(token)
-    dataframe.to_csv(os.path.join(uploads_path, fname))
+    token = get_token(phone, key, fmt)
+    fname = signed_filename(token, fmt)
+    write_dataframe(dataframe, os.path.join(uploads_path, fname), fmt, schema)
     return token
 
-def export_df(df, phone, uploads_path):
-    token = write_and_get_signed_path(phone, 'user_export', df, uploads_path)
+
+def stream_to_signed_path(token, pages, schema, uploads_path, fmt='csv'):
+    """write pages of records to the file for `token` (see `write_pages`).
+    The file only appears under its final name once it's complete.
+    """
+    fpath = os.path.join(uploads_path, signed_filename(token, fmt))
+    part_path = fpath + ".part"
+    n = write_pages(pages, part_path, schema, fmt)
+    os.replace(part_path, fpath)
+    return n
+
+
+def write_pages(pages, fpath, schema, fmt='csv'):
+    """write pages of records (lists of dicts) to a file, one page at a time,
+    so memory use doesn't grow with the number of records.
+    """
+    n = 0
+    if fmt == 'parquet':
+        with pq.ParquetWriter(fpath, schema, compression='zstd') as writer:
+            for page in pages:
+                writer.write_table(to_table(pd.DataFrame(page), schema))
+                n += len(page)
+    else:
+        with open(fpath, 'w') as f:
+            for i, page in enumerate(pages):
+                df = pd.DataFrame(page).reindex(columns=schema.names)
+                df.to_csv(f, header=(i == 0), index=False)
+                n += len(df)
+            if n == 0:
+                pd.DataFrame(columns=schema.names).to_csv(f, index=False)
+    return n
+
+
+def export_df(df, phone, uploads_path, fmt='csv'):
+    token = write_and_get_signed_path(phone, 'user_export', df, uploads_path, fmt)
     return token
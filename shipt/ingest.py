@@ -0,0 +1,121 @@
+import os
+import time
+import queue
+import threading
+import requests
+import pandas as pd
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from . import receipts
+
+MEDIA_WORKERS = int(os.environ.get('MEDIA_WORKERS', 4))
+# seconds to spend on a message's images before replying with what we have.
+# twilio gives up on a webhook after 15 seconds.
+MEDIA_DEADLINE = float(os.environ.get('MEDIA_DEADLINE', 12))
+DOWNLOAD_TIMEOUT = 5
+# 'sync' parses a message's images before replying to it. 'async' replies
+# right away and parses them on an ingest queue, texting the results after.
+INGEST_MODE = os.environ.get('INGEST_MODE', 'sync')
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', 2))
+# queued jobs aren't waiting on twilio, so they get longer for their images
+INGEST_DEADLINE = float(os.environ.get('INGEST_DEADLINE', 120))
+# how many recent job keys (message SIDs) to remember, to skip repeats
+MAX_KEYS = 10000
+
+# shared across requests, so a burst of messages can't start more than
+# MEDIA_WORKERS downloads/parses at once.
+executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS)
+
+
+def fetch_and_parse(image_url):
+    """downloads an image and parses it into a dataframe of shops.
+    """
+    print("Downloading image from:", image_url)
+    image_bytes = requests.get(image_url, timeout=DOWNLOAD_TIMEOUT).content
+    try:
+        return receipts.receipt_to_df(image_bytes)
+    except Exception as e:
+        print("Error parsing receipt:")
+        print(e)
+        return pd.DataFrame()
+
+
+def media_to_df(image_urls, deadline=MEDIA_DEADLINE):
+    """downloads and parses a message's images concurrently.
+
+    Returns a list with one dataframe per image, in the same order as
+    `image_urls`. Images that fail, or aren't done by `deadline` seconds,
+    come back as empty dataframes.
+    """
+    start = time.time()
+    futures = [executor.submit(fetch_and_parse, url) for url in image_urls]
+    done, not_done = wait(futures, timeout=deadline)
+    for f in not_done:
+        f.cancel()
+    dfs = []
+    for url, f in zip(image_urls, futures):
+        if f in done and f.exception() is None:
+            df = f.result()
+        else:
+            if f in done:
+                print("Error processing image {}: {}".format(url, f.exception()))
+            else:
+                print("Timed out processing image:", url)
+            df = pd.DataFrame()
+        df['media_url'] = url
+        dfs.append(df)
+    print("Processed {} images in {:.2f}s".format(len(image_urls),
+                                                  time.time() - start))
+    return dfs
+
+
+class LocalQueue():
+    """an in-process queue of ingest jobs, run by `workers` threads.
+
+    `enqueue` takes an idempotency key (the message SID) with each job, and
+    skips jobs whose key it has already seen, so twilio retrying a webhook
+    doesn't parse its images twice. Jobs are lost if the process exits.
+    """
+
+    def __init__(self, handler, workers=INGEST_WORKERS, max_keys=MAX_KEYS):
+        self.handler = handler
+        self.max_keys = max_keys
+        self.keys = OrderedDict()
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.threads = [threading.Thread(target=self._work, daemon=True)
+                        for _ in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def enqueue(self, key, job):
+        """queues `job` for the handler, unless a job with `key` was already
+        queued. Returns True if the job was queued.
+        """
+        if key is not None:
+            with self.lock:
+                if key in self.keys:
+                    print("Skipping repeated ingest job:", key)
+                    return False
+                self.keys[key] = True
+                while len(self.keys) > self.max_keys:
+                    self.keys.popitem(last=False)
+        self.jobs.put(job)
+        return True
+
+    def _work(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                start = time.time()
+                self.handler(job)
+                print("Finished ingest job in {:.2f}s".format(time.time() - start))
+            except Exception as e:
+                print("Error running ingest job:", e)
+            finally:
+                self.jobs.task_done()
+
+    def join(self):
+        """waits until every queued job is done.
+        """
+        self.jobs.join()
@@ -0,0 +1,116 @@
+import os
+import json
+import base64
+import hashlib
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+CHECKPOINT_EVERY = 50
+
+
+def file_md5(path):
+    """base64 md5 of a file, in the same format as google cloud storage's
+    `Blob.md5_hash`.
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode('utf-8')
+
+
+class LocalBlob():
+    """a file standing in for a cloud storage blob.
+    """
+
+    def __init__(self, root, name):
+        self.path = os.path.join(root, name)
+        self.name = name
+        self.size = os.path.getsize(self.path)
+        self.md5_hash = file_md5(self.path)
+
+    def download_to_filename(self, filename):
+        shutil.copyfile(self.path, filename)
+
+
+class LocalBucket():
+    """a directory standing in for a cloud storage bucket, for testing mirrors
+    without network access.
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def list_blobs(self):
+        for dirpath, _, filenames in os.walk(self.root):
+            for fname in sorted(filenames):
+                name = os.path.relpath(os.path.join(dirpath, fname), self.root)
+                yield LocalBlob(self.root, name)
+
+
+def is_mirrored(blob, path, checkpoint):
+    """True if the local copy of `blob` at `path` is already up to date.
+
+    Blobs finished in an earlier run are trusted if their size still matches,
+    otherwise we compare size and then md5.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) != blob.size:
+        return False
+    if blob.md5_hash is None:
+        return True
+    if checkpoint.get(blob.name) == blob.md5_hash:
+        return True
+    return file_md5(path) == blob.md5_hash
+
+
+def mirror_blobs(blobs, dest, workers=8, checkpoint_path=None):
+    """downloads `blobs` into `dest`, skipping ones that are already there.
+
+    Downloads run on `workers` threads. Finished blobs are recorded in a
+    checkpoint file (by default `dest/.mirror-checkpoint.json`), so an
+    interrupted mirror picks up where it left off.
+    Returns counts of downloaded, skipped and failed blobs.
+    """
+    os.makedirs(dest, exist_ok=True)
+    if checkpoint_path is None:
+        checkpoint_path = os.path.join(dest, ".mirror-checkpoint.json")
+    checkpoint = {}
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path) as f:
+            checkpoint = json.load(f)
+
+    def save_checkpoint():
+        tmp_path = checkpoint_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(tmp_path, checkpoint_path)
+
+    def download(blob, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = path + ".part"
+        blob.download_to_filename(part_path)
+        os.replace(part_path, path)
+
+    counts = {'downloaded': 0, 'skipped': 0, 'failed': 0}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for blob in blobs:
+            path = os.path.join(dest, blob.name)
+            if is_mirrored(blob, path, checkpoint):
+                counts['skipped'] += 1
+                checkpoint[blob.name] = blob.md5_hash
+                continue
+            futures[pool.submit(download, blob, path)] = blob
+        for future in as_completed(futures):
+            blob = futures[future]
+            if future.exception() is not None:
+                print("Error downloading {}: {}".format(blob.name, future.exception()))
+                counts['failed'] += 1
+                continue
+            print(blob.name)
+            counts['downloaded'] += 1
+            checkpoint[blob.name] = blob.md5_hash
+            if counts['downloaded'] % CHECKPOINT_EVERY == 0:
+                save_checkpoint()
+    save_checkpoint()
+    return counts
@@ -0,0 +1,230 @@
+import os
+import json
+import queue
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+import pytesseract
+
+# tesserocr binds the tesseract C++ API directly, so a loaded model can be kept
+# around between images. Fall back to shelling out through pytesseract when it
+# isn't installed (e.g. local dev without libtesseract headers).
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+PSM = 6
+N_WORKERS = int(os.environ.get('OCR_WORKERS', os.cpu_count() or 1))
+CACHE_ENTRIES = int(os.environ.get('OCR_CACHE_ENTRIES', 1024))
+CACHE_BYTES = int(os.environ.get('OCR_CACHE_BYTES', 64 * 1024 * 1024))
+CACHE_DIR = os.environ.get('OCR_CACHE_DIR')
+
+
+class OCREngine():
+    """a pool of warm tesseract instances.
+
+    Each worker owns one `PyTessBaseAPI` with the language data and page
+    segmentation mode already loaded, so submitting an image doesn't fork a new
+    process or reload the model. Images are grayscale numpy arrays (see
+    `receipts.preprocess`).
+    """
+
+    def __init__(self, workers=N_WORKERS, psm=PSM):
+        self.workers = workers
+        self.psm = psm
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.apis = queue.Queue()
+        if tesserocr is not None:
+            for _ in range(workers):
+                self.apis.put(tesserocr.PyTessBaseAPI(psm=psm))
+
+    def _image_to_string(self, image):
+        if tesserocr is None:
+            return pytesseract.image_to_string(image,
+                                               config='--psm {}'.format(self.psm))
+        api = self.apis.get()
+        try:
+            api.SetImage(Image.fromarray(image))
+            return api.GetUTF8Text()
+        finally:
+            self.apis.put(api)
+
+    def _image_to_data(self, image, psm=None, whitelist=None):
+        psm = self.psm if psm is None else psm
+        if tesserocr is None:
+            config = '--psm {}'.format(psm)
+            if whitelist is not None:
+                config += ' -c tessedit_char_whitelist={}'.format(whitelist)
+            data = pytesseract.image_to_data(image, config=config,
+                                             output_type=pytesseract.Output.DICT)
+            lines = OrderedDict()
+            for i, text in enumerate(data['text']):
+                if float(data['conf'][i]) < 0 or text.strip() == "":
+                    continue
+                line = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+                lines.setdefault(line, []).append({
+                    'text': text.strip(),
+                    'conf': float(data['conf'][i]),
+                    'box': [data['left'][i], data['top'][i],
+                            data['width'][i], data['height'][i]]})
+            return list(lines.values())
+        api = self.apis.get()
+        try:
+            api.SetPageSegMode(psm)
+            if whitelist is not None:
+                api.SetVariable('tessedit_char_whitelist', whitelist)
+            api.SetImage(Image.fromarray(image))
+            api.Recognize()
+            lines = []
+            for word in tesserocr.iterate_level(api.GetIterator(), tesserocr.RIL.WORD):
+                text = word.GetUTF8Text(tesserocr.RIL.WORD)
+                if text is None or text.strip() == "":
+                    continue
+                if len(lines) == 0 or word.IsAtBeginningOf(tesserocr.RIL.TEXTLINE):
+                    lines.append([])
+                x1, y1, x2, y2 = word.BoundingBox(tesserocr.RIL.WORD)
+                lines[-1].append({'text': text.strip(),
+                                  'conf': word.Confidence(tesserocr.RIL.WORD),
+                                  'box': [x1, y1, x2 - x1, y2 - y1]})
+            return lines
+        finally:
+            if whitelist is not None:
+                api.SetVariable('tessedit_char_whitelist', '')
+            api.SetPageSegMode(self.psm)
+            self.apis.put(api)
+
+    def submit(self, image):
+        """queue an image for OCR, returning a future with its text.
+        """
+        return self.executor.submit(self._image_to_string, image)
+
+    def image_to_string(self, image):
+        return self.submit(image).result()
+
+    def image_to_data(self, image, psm=None, whitelist=None):
+        """OCR an image into lines of words. Each word is a dict with its
+        `text`, `conf`idence (0-100) and `box` (x, y, width, height).
+
+        `psm` overrides the engine's page segmentation mode, and `whitelist`
+        limits the characters tesseract will read, for this image only.
+        """
+        return self.executor.submit(self._image_to_data, image, psm, whitelist).result()
+
+    def map(self, images):
+        """OCR several images across the pool, keeping their order.
+        """
+        return list(self.executor.map(self._image_to_string, images))
+
+    def map_data(self, images, psm=None, whitelist=None):
+        """`image_to_data` for several images across the pool, keeping their order.
+        """
+        return list(self.executor.map(
+            lambda image: self._image_to_data(image, psm, whitelist), images))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        while not self.apis.empty():
+            self.apis.get().End()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """returns the shared engine for this process, starting it on first use.
+    """
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            print("starting OCR engine with {} workers (tesserocr: {})".format(
+                N_WORKERS, tesserocr is not None))
+            _engine = OCREngine()
+        return _engine
+
+
+def cache_key(image_bytes, kind, version):
+    """content address for an OCR result: a hash of the image bytes, what kind
+    of result it is, and the version of the code that produced it.
+    """
+    h = hashlib.sha256(image_bytes)
+    h.update("{}:{}".format(kind, version).encode('utf-8'))
+    return h.hexdigest()
+
+
+class OCRCache():
+    """LRU cache of JSON-serializable OCR results, keyed by `cache_key`.
+
+    Bounded by both entry count and total (JSON) size. With `directory`,
+    results are also written there, one file per key, so several processes or
+    instances sharing the directory share results. Only the in-memory layer
+    is bounded.
+    """
+
+    def __init__(self, max_entries=CACHE_ENTRIES, max_bytes=CACHE_BYTES, directory=CACHE_DIR):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".json")
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return json.loads(self.entries[key])
+        if self.directory is not None and os.path.exists(self._path(key)):
+            with open(self._path(key)) as f:
+                value = f.read()
+            self._remember(key, value)
+            with self.lock:
+                self.hits += 1
+            return json.loads(value)
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def set(self, key, value):
+        value = json.dumps(value)
+        self._remember(key, value)
+        if self.directory is not None:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+            with open(tmp_path, 'w') as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+
+    def _remember(self, key, value):
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= len(self.entries.pop(key))
+            self.entries[key] = value
+            self.nbytes += len(value)
+            while len(self.entries) > self.max_entries or (
+                    self.nbytes > self.max_bytes and len(self.entries) > 1):
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= len(evicted)
+
+
+_cache = None
+
+
+def get_cache():
+    """returns the shared OCR result cache for this process.
+    """
+    global _cache
+    with _engine_lock:
+        if _cache is None:
+            _cache = OCRCache()
+        return _cache
@@ -8,219 +8,578 @@ import glob
 import pandas as pd
 import numpy as np
 import string
-import random
 import math
+import re
+import time
+from . import ocr
+
+
+# bump when a change to preprocessing or parsing would change the results, so
+# cached OCR results from older code aren't reused
+PARSER_VERSION = "9"
+
+# images are upscaled by a fixed OCR_SCALE for tesseract. With OCR_SCALE=auto,
+# they're instead upscaled so their text is about TARGET_TEXT_HEIGHT pixels
+# tall, within MIN_SCALE and MAX_SCALE (see `choose_scale`).
+TARGET_TEXT_HEIGHT = 32
+# used to pick a scale when the text can't be measured
+TARGET_WIDTH = 1500
+MIN_SCALE = 1.0
+MAX_SCALE = 3.0
+OCR_SCALE = os.environ.get('OCR_SCALE', '2')
+OCR_SCALE = None if OCR_SCALE == 'auto' else float(OCR_SCALE)
+
+# amounts read with less confidence than this (0-100) are OCR'd again on their
+# own, REOCR_SCALE times larger, as a single line of only DIGITS
+MIN_CONFIDENCE = float(os.environ.get('OCR_MIN_CONFIDENCE', 80))
+REOCR_SCALE = 2
+REOCR_PSM = 7
+DIGITS = "$0123456789.,"
+
+# only OCR the blocks of text in a screenshot, not the whole thing
+CROP_CARDS = os.environ.get('OCR_CROP_CARDS', '0') == '1'
+# fraction of the screen height taken by the phone's status bar
+STATUS_BAR_HEIGHT = 0.04
+# text blocks shorter than this fraction of the screen height are noise
+MIN_REGION_HEIGHT = 0.005
 
 
 def strip_punc(s): return s.translate(
     str.maketrans('', '', string.punctuation))
 
 
-def image_to_text(image_filename):
-    image = cv2.imread(image_filename)
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    # scale 1.5x
-    gray = cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
-    # enhancer = ImageEnhance.Contrast(gray)
-    # gray = enhancer.enhance(2)
-    # gray = gray.convert('1')
-    # random filename
-    filename = "/tmp/{}.png".format(os.getpid() + random.randint(1, 100))
-    cv2.imwrite(filename, gray)
-    text = pytesseract.image_to_string(Image.open(filename),
-                                       config='--psm 6')
-    os.remove(filename)
+def load_image(image):
+    """decode an image into a BGR numpy array without touching the filesystem.
+
+    `image` can be a filename, raw bytes, a file-like object (anything with a
+    `read` method), or an already-decoded numpy array.
+    """
+    if isinstance(image, np.ndarray):
+        return image
+    if isinstance(image, str):
+        return cv2.imread(image)
+    if hasattr(image, 'read'):
+        image = image.read()
+    buf = np.frombuffer(image, dtype=np.uint8)
+    return cv2.imdecode(buf, cv2.IMREAD_COLOR)
+
+
+def image_bytes(image):
+    """the raw bytes of an image, for hashing. Files and file-like objects are
+    read in full; numpy arrays are hashed along with their shape and dtype.
+    """
+    if isinstance(image, np.ndarray):
+        return "{}{}".format(image.shape, image.dtype).encode('utf-8') + image.tobytes()
+    if isinstance(image, str):
+        with open(image, 'rb') as f:
+            return f.read()
+    if hasattr(image, 'read'):
+        return image.read()
+    return bytes(image)
+
+
+def text_height(gray):
+    """estimates the height in pixels of the text in an image, from the median
+    height of character-sized connected components. Returns None if there
+    aren't enough to go on.
+    """
+    height, width = gray.shape[:2]
+    binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                                   cv2.THRESH_BINARY_INV, 25, 15)
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary)
+    w, h = stats[1:, cv2.CC_STAT_WIDTH], stats[1:, cv2.CC_STAT_HEIGHT]
+    chars = (h > 4) & (h < height * 0.05) & (w < width * 0.2)
+    if chars.sum() < 10:
+        return None
+    return float(np.median(h[chars]))
+
+
+def choose_scale(gray):
+    """picks how much to upscale an image so its text is about
+    TARGET_TEXT_HEIGHT pixels tall, the size tesseract reads best. Falls back
+    to scaling the width to TARGET_WIDTH if we can't measure the text.
+    """
+    measured = text_height(gray)
+    if measured is not None:
+        scale = TARGET_TEXT_HEIGHT / measured
+    else:
+        scale = TARGET_WIDTH / gray.shape[1]
+    return float(np.clip(scale, MIN_SCALE, MAX_SCALE)), measured
+
+
+def preprocess(image, scale=OCR_SCALE):
+    """grayscale and upscale an image for tesseract, keeping it as an array.
+
+    With scale=None, the scale is picked from the image (see `choose_scale`).
+    """
+    start = time.time()
+    image = load_image(image)
+    if image.ndim == 3:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = image
+    measured = None
+    if scale is None:
+        scale, measured = choose_scale(gray)
+    if scale != 1:
+        gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_CUBIC)
+    print("preprocessed {}x{} image (text height: {}) at scale {:.2f} in {:.0f}ms".format(
+        image.shape[1], image.shape[0],
+        "{:.0f}px".format(measured) if measured is not None else "-",
+        scale, (time.time() - start) * 1000))
+    return gray
+
+
+def cache_version():
+    """PARSER_VERSION plus the settings that change OCR results, so instances
+    with different settings that share OCR_CACHE_DIR don't read each other's.
+    """
+    return "{}:scale={}:min_conf={}".format(PARSER_VERSION, OCR_SCALE, MIN_CONFIDENCE)
+
+
+def find_card_regions(gray):
+    """finds the blocks of text in a screenshot, e.g. the order cards.
+
+    Text is binarized and smeared sideways so each line of text becomes one
+    blob. Lines are then merged into blocks wherever the gap between them is
+    smaller than a line's height, so the lines of a card end up together
+    while the blank space between cards (and around the edges) is dropped.
+    Lines in the status bar at the top of the screen, and specks too short to
+    be text, are ignored. Returns (x, y, w, h) boxes from top to bottom.
+    """
+    height, width = gray.shape[:2]
+    binary = cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C,
+                                   cv2.THRESH_BINARY_INV, 25, 15)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(width // 30, 1), 1))
+    blobs = cv2.dilate(binary, kernel)
+    contours, _ = cv2.findContours(blobs, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    lines = []
+    for c in contours:
+        x, y, w, h = cv2.boundingRect(c)
+        if y + h < height * STATUS_BAR_HEIGHT or h < height * MIN_REGION_HEIGHT:
+            continue
+        lines.append([x, y, x + w, y + h])
+    if len(lines) == 0:
+        return []
+    line_height = np.median([y1 - y0 for _, y0, _, y1 in lines])
+    lines.sort(key=lambda l: l[1])
+    blocks = [lines[0]]
+    for x0, y0, x1, y1 in lines[1:]:
+        block = blocks[-1]
+        if y0 - block[3] < line_height:
+            block[0], block[2] = min(block[0], x0), max(block[2], x1)
+            block[3] = max(block[3], y1)
+        else:
+            blocks.append([x0, y0, x1, y1])
+    pad = int(line_height // 2)
+    regions = []
+    for x0, y0, x1, y1 in blocks:
+        x0, y0 = max(x0 - pad, 0), max(y0 - pad, 0)
+        regions.append((x0, y0, min(x1 + pad, width) - x0, min(y1 + pad, height) - y0))
+    return regions
+
+
+def image_to_text(image, crop=CROP_CARDS):
+    """OCRs an image. With `crop`, only the text blocks found by
+    `find_card_regions` are OCR'd (in parallel), and their text joined from
+    top to bottom.
+    """
+    if not isinstance(image, np.ndarray):
+        image = image_bytes(image)
+    kind = 'text-crop' if crop else 'text'
+    key = ocr.cache_key(image_bytes(image), kind, cache_version())
+    text = ocr.get_cache().get(key)
+    if text is None:
+        gray = preprocess(image)
+        regions = find_card_regions(gray) if crop else []
+        if len(regions) > 0:
+            texts = ocr.get_engine().map([gray[y:y + h, x:x + w]
+                                          for x, y, w, h in regions])
+            text = "\n".join(texts)
+        else:
+            text = ocr.get_engine().image_to_string(gray)
+        ocr.get_cache().set(key, text)
     return text
 
 
-def is_number(s):
-    try:
-        float(s)
-        return True
-    except ValueError:
-        return False
+def image_to_words(image, crop=CROP_CARDS):
+    """OCRs an image into lines of words (see `ocr.OCREngine.image_to_data`),
+    with boxes in the coordinates of the preprocessed image. See
+    `image_to_text` for `crop`.
+    """
+    if not isinstance(image, np.ndarray):
+        image = image_bytes(image)
+    kind = 'words-crop' if crop else 'words'
+    key = ocr.cache_key(image_bytes(image), kind, cache_version())
+    lines = ocr.get_cache().get(key)
+    if lines is None:
+        gray = preprocess(image)
+        regions = find_card_regions(gray) if crop else []
+        if len(regions) > 0:
+            lines = []
+            region_lines = ocr.get_engine().map_data([gray[y:y + h, x:x + w]
+                                                      for x, y, w, h in regions])
+            for (x, y, _, _), region in zip(regions, region_lines):
+                for line in region:
+                    for word in line:
+                        word['box'][0] += x
+                        word['box'][1] += y
+                    lines.append(line)
+        else:
+            lines = ocr.get_engine().image_to_data(gray)
+        ocr.get_cache().set(key, lines)
+    return lines
 
 
-def bad_entries_to_na(data):
-    for k, v in data.items():
-        if k in ['delivery_window_start', 'delivery_window_end',
-                 'order_pay', 'order_total', 'tip', 'total_pay']:
+# amounts within this of each other are the same, give or take float error
+PAY_TOLERANCE = 0.005
 
-            test_str = str(v).replace("PM", "").replace("AM", "")
-            if not is_number(test_str):
-                data[k] = np.nan
-    return data
 
+def reconcile(df):
+    """fixes misread amounts in a dataframe of shops, all rows at once.
 
-def to_number_or_none(x):
-    try:
-        return pd.to_numeric(x)
-    except:
-        return None
+    Order pay and tip can't be more than total pay, so if they are, their
+    decimal point was probably missed: shift it left until they fit. Then, if
+    order pay, tip and promo pay don't add up to total pay, fix whichever is
+    most likely wrong. Shops whose order number isn't a number get a new one
+    made from their pay: <tip><total pay><delivery day-of-month>.
+
+    Rows missing order pay, tip, promo pay or total pay are left alone. Amounts
+    that aren't numbers, like the "" of a stored shop, count as missing.
+    """
+    df = df.copy()
+    for field in MONEY_FIELDS:
+        df[field] = pd.to_numeric(df[field], errors='coerce') if field in df else np.nan
+    ok = df[["order_pay", "tip", "promo_pay", "total_pay"]].notna().all(axis=1)
 
+    for field in ["order_pay", "tip"]:
+        too_big = ok & (df[field] > df["total_pay"] + PAY_TOLERANCE)
+        while too_big.any():
+            df.loc[too_big, field] = (df.loc[too_big, field] / 10).round(2)
+            too_big = ok & (df[field] > df["total_pay"] + PAY_TOLERANCE)
 
-def guess_better_numbers(data):
-    """ Guesses better numbers if the order pay, tip, promo pay, and total pay don't add up.
-    also creates a new order number from the pay #s if it's been parsed wrong. We check if the order 
-    number has been parsed wrong by testing if it's parse-able into a number.
-    new order # is: <tip><totalpay><delivery day-of-month>
-    """
-    if 'tip' not in data or 'order_pay' not in data or 'promo_pay' not in data:
-        return data
-    data['tip'] = to_number_or_none(data['tip'])
-    data['total_pay'] = to_number_or_none(data['total_pay'])
-    data['order_pay'] = to_number_or_none(data['order_pay'])
-    data['promo_pay'] = to_number_or_none(data['promo_pay'])
-    if (data['order_pay'] == None or data['total_pay'] == None):
-        return data
-    while data['order_pay'] > data['total_pay']:
-        data['order_pay'] = round(data['order_pay'] / 10, 2)
-
-    while data['tip'] > data['total_pay']:
-        data['tip'] = round(data['tip'] / 10, 2)
-
-    if data['tip'] + data['order_pay'] + data['promo_pay'] != data['total_pay']:
-        # the order pay is *always* a decimal, basically. if it's not,
-        # it almost definitely means it was parsed incorrectly.
-        # breaks, obviously, when tip is greater than promo pay, but that
-        # rarely happens.
-        if data['order_pay'] > data['total_pay']:
-            data['order_pay'] == data['total_pay'] - \
-                data['promo_pay'] - data['tip']
-        elif data['total_pay'] > data['order_pay'] + data['tip'] + data['promo_pay']:
-            data['total_pay'] = data['order_pay'] + \
-                data['tip'] + data['promo_pay']
-        elif data['tip'] > data['total_pay']:
-            data['tip'] = data['total_pay'] - \
-                data['order_pay'] - data['promo_pay']
+    order_pay, tip, promo_pay, total_pay = (
+        df["order_pay"], df["tip"], df["promo_pay"], df["total_pay"])
+    paid = order_pay + tip + promo_pay
+    mismatched = ok & ((paid - total_pay).abs() > PAY_TOLERANCE)
+    # the order pay is *always* a decimal, basically. if it's not, it almost
+    # definitely means it was parsed incorrectly. breaks, obviously, when tip
+    # is greater than promo pay, but that rarely happens.
+    fix_order_pay = mismatched & (order_pay > total_pay)
+    fix_total_pay = mismatched & ~fix_order_pay & (total_pay > paid)
+    fix_tip = mismatched & ~fix_order_pay & ~fix_total_pay & (tip > total_pay)
+    df["order_pay"] = np.where(fix_order_pay, (total_pay - promo_pay - tip).round(2), order_pay)
+    df["total_pay"] = np.where(fix_total_pay, paid.round(2), total_pay)
+    df["tip"] = np.where(fix_tip, (total_pay - order_pay - promo_pay).round(2), tip)
 
     # order number
-    new_ordernum = "{}{}{}".format(
-                int(data['tip']), 
-                int(data['total_pay']),
-                data['delivery_date'].split('/')[1])
-    if 'order_number' not in data:
-        data['order_number'] = new_ordernum
+    if "order_number" not in df:
+        df["order_number"] = np.nan
+    if "delivery_date" not in df:
+        df["delivery_date"] = np.nan
+    redacted = ok & ~df["order_number"].astype(str).str.fullmatch(r"\s*\d+\s*")
+    if redacted.any():
+        rows = df[redacted]
+        df.loc[redacted, "order_number"] = (
+            rows["tip"].astype(int).astype(str)
+            + rows["total_pay"].astype(int).astype(str)
+            + rows["delivery_date"].astype(str).str.split("/").str[1])
+    return df
+
+
+def receipt_to_df(image, verbose=False, crop=CROP_CARDS, reconciled=True):
+    """parses shops out of a receipt screenshot into a dataframe.
+
+    `image` can be a filename, raw bytes, a file-like object or a numpy array
+    (see `load_image`). Only filenames are recorded in the `filename` column.
+    See `image_to_text` for `crop`, and `words_to_df` for the confidence columns.
+    With reconciled=False, shops are left as they were read, for a batch of
+    images to be reconciled together with `finish_shops`.
+    """
+    image_filename = image if isinstance(image, str) else ""
+    if not isinstance(image, np.ndarray):
+        image = image_bytes(image)
+    kind = 'rows-crop' if crop else 'rows'
+    key = ocr.cache_key(image_bytes(image), kind, cache_version())
+    shops = ocr.get_cache().get(key)
+    if shops is not None:
+        if verbose:
+            print("OCR cache hit for", image_filename)
     else:
-        try:
-            ordernum = int(data['order_number'])
-        except ValueError:
-            data['order_number'] = new_ordernum
-    return data
+        shops = _words_to_shops(image_to_words(image, crop), image, image_filename, verbose)
+        ocr.get_cache().set(key, shops)
+    df = _shops_to_df(shops, reconciled)
+    df["filename"] = image_filename
+    return df
+
 
-def receipt_to_df(image_filename, verbose=False):
-    text = image_to_text(image_filename)
-    def fword(s): return s.split(" ")[0]
-    def line_items(s): return s.split(" ")
-    all_data = []
+MONEY_FIELDS = ["order_pay", "tip", "order_total", "total_pay", "promo_pay"]
+# the first character of an amount is dropped: it's the dollar sign, or
+# whatever tesseract misread it as
+MONEY = re.compile(r'^.(\d[\d,]*(?:\.\d*)?)')
+WINDOW_RANGE = re.compile(r'^(?P<start>.*?)to(?P<end>.*)$')
+# characters tesseract reads the dot between an order number and its total as
+TOTAL_SEPARATORS = set("+*-»«")
+
+
+def parse_money(token):
+    """'$1,234.56' -> 1234.56, or None if it isn't an amount.
+    """
+    m = MONEY.match(token)
+    if m is None:
+        return None
+    return float(m.group(1).replace(",", ""))
+
+
+def _window(m, tokens, next_line):
+    # assume current year
+    date = datetime.strptime("{} {} {}".format(
+        m.group('month')[:3], m.group('day'), datetime.today().year), "%b %d %Y")
+    datestr = datetime.strftime(date, "%m/%d/%Y")
+    return {'delivery_window_start': m.group('start'),
+            'delivery_window_end': m.group('end'),
+            'delivery_date': datestr,
+            'delivered_date': datestr}
+
+
+def _delivery_only(m, tokens, next_line):
+    return {'delivery_only': True}
+
+
+def _delivery(m, tokens, next_line):
     data = {}
+    if 'window' in m.string.lower():
+        line = m.string
+        if len(tokens) == 2:
+            line = " ".join([line, next_line])
+            tokens = line.split()
+        window = WINDOW_RANGE.match(line.split(":")[-1])
+        data['delivery_date'] = tokens[2].split(":")[0].strip()
+        if window is not None:
+            data['delivery_window_start'] = strip_punc(window.group('start').strip())
+            data['delivery_window_end'] = strip_punc(window.group('end').strip())
+    return data
+
+
+def _delivered(m, tokens, next_line):
+    date = m.group('date').rstrip(",")
+    if date == "Today":
+        date = datetime.now().strftime("%m/%d/%Y")
+    return {'delivered_date': date, 'delivered_time': " ".join(tokens[2:])}
+
+
+def _order_pay(m, tokens, next_line):
+    return {'order_pay': parse_money(m.group('amount'))}
+
+
+def _order(m, tokens, next_line):
+    # remove hash
+    data = {'order_number': strip_punc(tokens[1]), 'order_total': None}
+    # new cards only have 4 on this line, and some don't have an order total.
+    # sometimes tesseract picks up the dot between the order number and the
+    # total as a plus or an arrow, but sometimes it doesn't.
+    if len(tokens) >= 4:
+        if len(tokens[2]) == 1 or any(c in TOTAL_SEPARATORS for c in tokens[2]):
+            data['order_total'] = parse_money(tokens[3])
+        else:
+            data['order_total'] = parse_money(tokens[2])
+    if "Time" in tokens[-1]:
+        data['late'] = False
+    elif "Late" in tokens[-1]:
+        data['late'] = True
+    return data
+
+
+def _tip(m, tokens, next_line):
+    return {'tip': parse_money(tokens[-1])}
+
+
+def _promo(m, tokens, next_line):
+    return {'promo_pay': parse_money(m.group('amount'))}
+
+
+def _total(m, tokens, next_line):
+    return {'total_pay': parse_money(m.group('amount'))}
+
+
+# the lines of a shipt order card: (field, pattern, handler), tried in order.
+# A handler gets the match, the line's tokens and the line after it, and
+# returns the fields it parsed. A card ends at its 'total' line, or if that
+# couldn't be read, at the next card's 'order' line. Lines missing their
+# amount don't match at all.
+CARD_LINES = [
+    ('window', re.compile(
+        r'^Window\s+(?P<month>[A-Za-z]+),?\s+(?P<day>\d{1,2}),?\s+(?P<start>[^\s-]+)-(?P<end>\S+)'),
+     _window),
+    ('delivery_only', re.compile(r'^Delivery\s+Only\b'), _delivery_only),
+    ('delivery', re.compile(r'^Delivery\b'), _delivery),
+    ('delivered', re.compile(r'^Delivered\s+(?P<date>\S+)'), _delivered),
+    ('order_pay', re.compile(r'^Order\s+Pay\s+(?P<amount>\S+)'), _order_pay),
+    ('order', re.compile(r'^Order\s+(?!Pay\b)\S'), _order),
+    ('tip', re.compile(r'^Tip\s+\S'), _tip),
+    ('promo', re.compile(r'^Promo\s+\S+\s+(?P<amount>\S+)'), _promo),
+    ('total', re.compile(r'^Total\s+\S+\s+(?P<amount>\S+)'), _total),
+]
+# the lines at the top of a card, before its 'order' line
+CARD_HEADERS = {'window', 'delivery_only', 'delivery', 'delivered'}
+
+
+def _parse_cards(lines, image_filename="", verbose=False):
+    """parses lines of receipt text into (shop, field_lines) pairs, where
+    field_lines maps each field of the shop to the number of the line it was
+    read from.
+    """
+    cards = []
+    data, field_lines = {}, {}
+    # header lines read after a card's 'order' line, which belong to the next card
+    next_lines = []
+
+    def end_card(data, field_lines):
+        data.setdefault('promo_pay', 0)
+        data['filename'] = image_filename
+        ## make sure order_total is in there too -- if it's not, we can't use it as data.
+        if 'order_total' in data:
+            if verbose:
+                print("Adding", data, "to shops...")
+            cards.append((data, field_lines))
+
+    def start_card():
+        data, field_lines = {}, {}
+        for field, parsed, n in next_lines:
+            add_line(data, field_lines, field, parsed, n)
+        next_lines.clear()
+        return data, field_lines
+
+    def add_line(data, field_lines, field, parsed, n):
+        if field == 'delivery':
+            data.setdefault('delivery_only', False)
+        data.update(parsed)
+        field_lines.update((k, n) for k in parsed)
+
+    for n, line in enumerate(lines):
+        for field, pattern, handler in CARD_LINES:
+            m = pattern.match(line)
+            if m is not None:
+                break
+        else:
+            continue
+        tokens = line.split()
+        next_line = lines[n + 1] if n + 1 < len(lines) else ""
+        if verbose:
+            print(field, tokens)
+        parsed = handler(m, tokens, next_line)
+        if field in CARD_HEADERS and 'order_number' in data:
+            next_lines.append((field, parsed, n))
+            continue
+        if field == 'order' and 'order_number' in data:
+            # this card's total couldn't be read, so it ends here instead
+            end_card(data, field_lines)
+            data, field_lines = start_card()
+        add_line(data, field_lines, field, parsed, n)
+        if field == 'total':
+            end_card(data, field_lines)
+            data, field_lines = start_card()
+    return cards
+
+
+def parse_receipt_text(text, image_filename="", verbose=False):
+    """parses the text of a receipt screenshot into a list of shops, one dict
+    per order card, with amounts as floats (or None if they couldn't be read).
+    The amounts are as read; see `reconcile` for fixing them up.
+
+    Works on text from any source, not just tesseract.
+    """
+    return [shop for shop, _ in _parse_cards(text.split("\n"), image_filename, verbose)]
+
+
+def finish_shops(df):
+    """reconciles a dataframe of parsed shops (see `reconcile`), drops the ones
+    without an order number, and fills in missing values. Confidence columns
+    stay floats, with NaN where an amount has no confidence.
+    """
+    df = reconcile(df)
+    df = df[df["order_number"].notna() & (df["order_number"] != "")]
+    conf = [c for c in df.columns if c.endswith("_conf")]
+    df = df.astype({c: float for c in conf})
+    return df.fillna({c: "" for c in df.columns if c not in conf})
+
+
+def _shops_to_df(shops, reconciled=True):
+    df = pd.DataFrame(shops).assign(date_submitted=datetime.now().strftime("%m/%d/%Y"))
+    if reconciled:
+        return finish_shops(df)
+    return df
+
+
+def text_to_df(text, image_filename="", verbose=False):
+    """parses shops out of OCR'd receipt text into a dataframe.
+    """
     if verbose:
         print("-----------------")
         print(image_filename)
-    lines = text.split("\n")
-    for n, line in enumerate(lines):
-        first_word = fword(line)
-        if verbose:
-            print(line_items(line))
-            print('window' in line.lower())
-            print(line.lower())
-            print(first_word)
-
-        if (first_word == 'Window'):
-            if (verbose):
-                print("new delivery window parsing...")
-            lm = line_items(line)
-            month = lm[1]
-            day = lm[2]
-            times = lm[3].split("-")
-            # assume current year
-            year = datetime.today().year
-            date = datetime.strptime("{} {} {}".format(
-                month, day, year), "%b %d, %Y")
-            datestr = datetime.strftime(date, "%m/%d/%Y")
-            data['delivery_window_start'] = times[0]
-            data['delivery_window_end'] = times[1]
-            data['delivery_date'] = datestr
-            data['delivered_date'] = datestr
-
-        elif (first_word == 'Delivery'):
-            if line_items(line)[1] == "Only":
-                data["delivery_only"] = True
-                continue
-            elif "delivery_only" not in data:
-                data["delivery_only"] = False
-
-            if 'window' in line.lower():
-                if (verbose):
-                    print("delivery window parsing...", line, lines[n+1])
-                if len(line_items(line)) == 2:
-                    line = " ".join([line, lines[n+1]])
-                delivery_window = line.split(":")[-1]  # gets the XX to XX
-                data["delivery_date"] = line_items(line)[2].split(":")[
-                    0].strip()  # removes colon
-                data["delivery_window_start"] = strip_punc(
-                    delivery_window.split("to")[0].strip())
-                data["delivery_window_end"] = strip_punc(
-                    delivery_window.split("to")[1].strip())
-        elif (first_word == 'Delivered'):
-            data["delivered_date"] = line_items(line)[1][:-1]  # removes comma
-            if data["delivered_date"] == "Today":
-                data["delivered_date"] = datetime.now().strftime("%m/%d/%Y")
-            data["delivered_time"] = " ".join(
-                line_items(line)[2:])  # merges time and AM/PM
-        elif (first_word == 'Order' and line_items(line)[1] == 'Pay'):
-            data["order_pay"] = line_items(
-                line)[2][1:].strip().replace(",", "")
-        elif (first_word == 'Order'):
-
-            # new cards only have 4 on this line
-            data["order_number"] = strip_punc(
-                line_items(line)[1])  # remove hash
-
-            # Some of them don't have an order total
-            if len(line_items(line)) >= 4:
-
-                # sometimes it picks up the dot between total and the amount as a plus
-                # or an arrow but sometimes, it doesn't. If it has this, it's pretty
-                # likely there's an order total.
-                if (any(c in line_items(line)[2].strip() for c in ["+", "*", "-", "»", "«"]) or
-                        len(line_items(line)[2]) == 1):
-                    print("ORDER TOTAL")
-                    data["order_total"] = line_items(
-                        line)[3][1:].strip().replace(",", "")
-                    print(data['order_total'])
-                else:
-                    print("ORDER total 2222")
-                    data["order_total"] = line_items(
-                        line)[2][1:].strip().replace(",", "")
-                    print(data['order_total'])
-            else:
-                data["order_total"] = np.nan
-            if "Time" in line_items(line)[-1]:
-                data["late"] = False
-            elif "Late" in line_items(line)[-1]:
-                data["late"] = True
-        elif (first_word == "Tip"):
-            data["tip"] = line_items(line)[-1][1:]
-        elif (first_word == 'Promo'):
-            data["promo_pay"] = line_items(line)[2][1:].strip()
-        elif (first_word == "Total"):
-            data["total_pay"] = line_items(
-                line)[2][1:].strip().replace(",", "")
-            if 'promo_pay' not in data:
-                data['promo_pay'] = 0
-            data["filename"] = image_filename
-            data = guess_better_numbers(data)
-            ## make sure order_total is in there too -- if it's not, we can't use it as data.
-            if 'order_number' in data and data['order_number'] != '' and 'order_total' in data:
-                if verbose:
-                   print("Adding", data, "to all_data...")
-                all_data.append(data)
-            data = {}
+    return _shops_to_df(parse_receipt_text(text, image_filename, verbose))
+
+
+def reocr_amounts(gray, boxes):
+    """OCRs the amounts in `boxes` of a preprocessed image again, one at a
+    time, larger and reading only digits. Returns an (amount, confidence) pair
+    for each box, or (None, None) if no amount could be read.
+
+    The crop still has the amount's dollar sign, which the digit whitelist can
+    read as a digit, so the first character is dropped like in `parse_money`.
+    """
+    crops = []
+    for x, y, w, h in boxes:
+        pad = h // 2
+        crop = gray[max(y - pad, 0):y + h + pad, max(x - pad, 0):x + w + pad]
+        crops.append(cv2.resize(crop, None, fx=REOCR_SCALE, fy=REOCR_SCALE,
+                                interpolation=cv2.INTER_CUBIC))
+    results = []
+    for lines in ocr.get_engine().map_data(crops, psm=REOCR_PSM, whitelist=DIGITS):
+        words = [word for line in lines for word in line]
+        amount = parse_money("".join(word['text'] for word in words))
+        if amount is None:
+            results.append((None, None))
         else:
-            continue
-    df = pd.DataFrame(all_data)
-    df["date_submitted"] = datetime.now().strftime("%m/%d/%Y")
-    df[["order_pay", "tip", "order_total", "total_pay", "promo_pay"]] = df[["order_pay", "tip",
-                                                                            "order_total", "total_pay", "promo_pay"]].apply(to_number_or_none)
-    return df.fillna("")
+            results.append((amount, min(word['conf'] for word in words)))
+    return results
+
+
+def words_to_df(lines, image, image_filename="", verbose=False, reconciled=True):
+    """parses shops out of OCR'd words (see `image_to_words`) into a dataframe,
+    with the confidence of each amount in a `<field>_conf` column.
+
+    Amounts read with less than MIN_CONFIDENCE are OCR'd again on their own
+    from `image` (see `reocr_amounts`), and replaced if that reads them better.
+    """
+    return _shops_to_df(_words_to_shops(lines, image, image_filename, verbose), reconciled)
+
+
+def _words_to_shops(lines, image, image_filename="", verbose=False):
+    if verbose:
+        print("-----------------")
+        print(image_filename)
+    text_lines = [" ".join(word['text'] for word in line) for line in lines]
+    cards = _parse_cards(text_lines, image_filename, verbose)
+    retry = []
+    for shop, field_lines in cards:
+        for field in MONEY_FIELDS:
+            if shop.get(field) is None or field not in field_lines:
+                continue
+            word = next((word for word in lines[field_lines[field]]
+                         if parse_money(word['text']) == shop[field]), None)
+            if word is None:
+                continue
+            shop[field + '_conf'] = word['conf']
+            if word['conf'] < MIN_CONFIDENCE:
+                retry.append((shop, field, word['box']))
+    if len(retry) > 0:
+        results = reocr_amounts(preprocess(image), [box for _, _, box in retry])
+        for (shop, field, _), (amount, conf) in zip(retry, results):
+            if verbose:
+                print("re-OCR'd {} {} ({:.0f}) as {} ({})".format(
+                    field, shop[field], shop[field + '_conf'], amount, conf))
+            if amount is not None and conf > shop[field + '_conf']:
+                shop[field] = amount
+                shop[field + '_conf'] = conf
+    return [shop for shop, _ in cards]
@@ -0,0 +1,117 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_SESSIONS = 10000
+
+
+class SessionStore():
+    """write-behind cache of phone sessions in front of a FirestoreBackend.
+
+    `get` reads a session from the backend. `stage` records which keys of a
+    session changed since it was last seen, and `flush` writes only those
+    keys. Staging several times before a flush coalesces into one write.
+    """
+
+    def __init__(self, backend, max_sessions=MAX_SESSIONS):
+        self.backend = backend
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.changed = {}
+        self.deleted = {}
+        self.lock = threading.Lock()
+        # a single writer, so a phone's flushes land in the order they were made
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def _remember(self, phone, session_dict):
+        self.sessions[phone] = dict(session_dict)
+        self.sessions.move_to_end(phone)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def get(self, phone):
+        """the stored session for a phone, or None if it doesn't have one.
+
+        Always reads the backend, since another instance may have written the
+        session since we last saw it. Changes staged here but not yet written
+        are applied on top.
+        """
+        session_dict = self.backend.get_phone_session(phone)
+        with self.lock:
+            changed = self.changed.get(phone, {})
+            deleted = self.deleted.get(phone, set())
+            if session_dict is None and len(changed) == 0:
+                self._remember(phone, {})
+                return None
+            session_dict = dict(session_dict or {}, **changed)
+            for k in deleted:
+                session_dict.pop(k, None)
+            self._remember(phone, session_dict)
+        return dict(session_dict)
+
+    def stage(self, phone, session_dict):
+        """records the keys of `session_dict` that changed, to write on flush.
+        """
+        with self.lock:
+            previous = self.sessions.get(phone, {})
+            changed = self.changed.setdefault(phone, {})
+            deleted = self.deleted.setdefault(phone, set())
+            for k, v in session_dict.items():
+                if k not in previous or previous[k] != v:
+                    changed[k] = v
+                    deleted.discard(k)
+            for k in previous:
+                if k not in session_dict:
+                    changed.pop(k, None)
+                    deleted.add(k)
+            self._remember(phone, session_dict)
+
+    def flush(self, phone):
+        """writes a phone's staged changes, if there are any. If the write
+        fails, the changes are staged again for the next flush. Returns True
+        unless the write failed.
+        """
+        with self.lock:
+            changed = self.changed.pop(phone, {})
+            deleted = self.deleted.pop(phone, set())
+        if len(changed) == 0 and len(deleted) == 0:
+            return True
+        print("Pushing {} changed session keys to firebase".format(
+            len(changed) + len(deleted)))
+        try:
+            self.backend.update_phone_session(phone, changed, deleted)
+        except Exception as e:
+            print("Error writing session for {}, will retry on next flush: {}".format(
+                phone, e))
+            self._restage(phone, changed, deleted)
+            return False
+        return True
+
+    def _restage(self, phone, changed, deleted):
+        """puts back changes from a failed flush, under any staged since.
+        """
+        with self.lock:
+            now_changed = self.changed.setdefault(phone, {})
+            now_deleted = self.deleted.setdefault(phone, set())
+            for k, v in changed.items():
+                if k not in now_changed and k not in now_deleted:
+                    now_changed[k] = v
+            for k in deleted:
+                if k not in now_changed:
+                    now_deleted.add(k)
+
+    def flush_async(self, phone):
+        return self.executor.submit(self.flush, phone)
+
+    def forget(self, phone):
+        """drops a phone's session and any changes to it that haven't been
+        written. This runs on the writer after the flushes already queued, so
+        none of them can land after it. Returns its future.
+        """
+        return self.executor.submit(self._forget, phone)
+
+    def _forget(self, phone):
+        with self.lock:
+            self.sessions.pop(phone, None)
+            self.changed.pop(phone, None)
+            self.deleted.pop(phone, None)
@@ -1,9 +1,27 @@
 from google.cloud import firestore
+from google.api_core import exceptions
 from fuzzywuzzy import fuzz
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from . import receipts
 
+# firestore's limit on writes in a single batch
+BATCH_SIZE = 500
+# errors worth retrying a batch commit on, mostly contention on hot documents
+# like a delete's progress counter
+RETRY_ERRORS = (exceptions.Aborted, exceptions.DeadlineExceeded,
+                exceptions.ServiceUnavailable, exceptions.TooManyRequests)
+
+# seconds a background job's lease lasts without a heartbeat. Another instance
+# can only take a job over once its lease has run out.
+LEASE_SECONDS = 60
+
 class FirestoreBackend():
     def __init__(self, prefix=""):
         self.db = firestore.Client()
@@ -11,7 +29,58 @@ class FirestoreBackend():
             "{}shops".format(prefix))
         self.phones_collection = lambda: self.db.collection(
             "{}phones".format(prefix))
+        self.metros_collection = lambda: self.db.collection(
+            "{}metros".format(prefix))
+        self.deletions_collection = lambda: self.db.collection(
+            "{}deletions".format(prefix))
+        self.replies_collection = lambda: self.db.collection(
+            "{}replies".format(prefix))
+        self.broadcasts_collection = lambda: self.db.collection(
+            "{}broadcasts".format(prefix))
         self.n_added = 0
+        # identifies this instance as the owner of the jobs it leases
+        self.instance_id = uuid.uuid4().hex
+        # per-thread cache of each phone's shops, only active between
+        # start_request_cache and end_request_cache
+        self._local = threading.local()
+
+    def start_request_cache(self):
+        """starts caching shop queries for the current request.
+
+        Every query for a phone's shops in the request is then served from one
+        read of that phone's shops. Writes through add_shops and
+        delete_phone_records keep the cache up to date.
+        """
+        self._local.shops = {}
+
+    def end_request_cache(self):
+        self._local.shops = None
+
+    def _phone_shops_all(self, phone):
+        """all shops for a phone, including delivery_only shops.
+        """
+        cache = getattr(self._local, 'shops', None)
+        if cache is not None and phone in cache:
+            return cache[phone]
+        phone_records = self.shops_collection().where('phone', '==', phone).stream()
+        shops = pd.DataFrame([r.to_dict() for r in phone_records])
+        if cache is not None:
+            cache[phone] = shops
+        return shops
+
+    def _update_cached_shops(self, phone, df):
+        cache = getattr(self._local, 'shops', None)
+        if cache is None or phone not in cache:
+            return
+        shops = cache[phone]
+        if len(shops) > 0:
+            shops = shops[~shops['order_number'].isin(df['order_number'])]
+        cache[phone] = pd.concat([shops, df], ignore_index=True)
+
+    def _invalidate_cached_shops(self, phone):
+        cache = getattr(self._local, 'shops', None)
+        if cache is not None:
+            cache.pop(phone, None)
 
     def get_all_shops(self):
         phone_records = self.shops_collection().stream()
@@ -21,6 +90,53 @@ class FirestoreBackend():
         phone_records = self.phones_collection().stream()
         return [r.to_dict() for r in phone_records]
 
+    def iter_shop_pages(self, page_size=1000, since=None):
+        """pages of shops, or with `since`, only shops ingested after it.
+        """
+        return self._iter_pages(self.shops_collection(), page_size,
+                                since, 'ingested_at')
+
+    def iter_phone_pages(self, page_size=1000, since=None):
+        """pages of phones, or with `since`, only phones updated after it.
+        """
+        return self._iter_pages(self.phones_collection(), page_size,
+                                since, 'updated_at')
+
+    def _iter_pages(self, collection, page_size, since=None, since_field=None):
+        """yields a collection's records as lists of dicts, `page_size` at a
+        time, using a query cursor rather than holding one long stream open.
+
+        With `since`, only yields records whose `since_field` timestamp is
+        after it, as a range query on that field.
+        """
+        if since is None:
+            query = collection.order_by('__name__')
+        else:
+            query = collection.where(since_field, '>', since).order_by(since_field)
+        query = query.limit(page_size)
+        last = None
+        while True:
+            page_query = query if last is None else query.start_after(last)
+            docs = list(page_query.stream())
+            if len(docs) == 0:
+                return
+            yield [d.to_dict() for d in docs]
+            if len(docs) < page_size:
+                return
+            last = docs[-1]
+
+    def backfill_timestamps(self):
+        """sets ingested_at/updated_at on shops and phones written before we
+        kept them, so incremental exports can find them. They get the time of
+        the backfill.
+        """
+        for collection, field in [(self.shops_collection(), 'ingested_at'),
+                                  (self.phones_collection(), 'updated_at')]:
+            writes = [(doc.reference, {field: firestore.SERVER_TIMESTAMP})
+                      for doc in collection.stream() if field not in doc.to_dict()]
+            print("backfilling {} on {} records".format(field, len(writes)))
+            self._commit_writes(writes, max_workers=8)
+
     def get_phone_session(self, phone):
         ref = self.phones_collection().document(phone)
         doc = ref.get()
@@ -29,47 +145,364 @@ class FirestoreBackend():
                 return doc.to_dict()['session']
         return None
 
+    def get_message_reply(self, message_sid):
+        """the saved reply to a message, or None if there isn't one or it's expired.
+        """
+        doc = self.replies_collection().document(message_sid).get()
+        if not doc.exists:
+            return None
+        reply = doc.to_dict()
+        if reply['expires'] < datetime.now(timezone.utc):
+            return None
+        return reply.get('response')
+
+    def claim_message(self, message_sid, timeout):
+        """claims a message for this instance to handle, in a transaction, unless
+        another instance already replied to it or is handling it. Returns None if
+        the message was claimed, otherwise the saved reply ('' if it's still
+        being handled). A claim lapses after `timeout` seconds.
+        """
+        ref = self.replies_collection().document(message_sid)
+
+        @firestore.transactional
+        def claim(transaction):
+            now = datetime.now(timezone.utc)
+            doc = ref.get(transaction=transaction)
+            if doc.exists and doc.to_dict()['expires'] > now:
+                return doc.to_dict().get('response', '')
+            transaction.set(ref, {'status': 'in_progress',
+                                  'expires': now + timedelta(seconds=timeout)})
+            return None
+
+        return claim(self.db.transaction())
+
+    def release_message(self, message_sid):
+        """drops a claim on a message, so a retry of it is handled again.
+        """
+        self.replies_collection().document(message_sid).delete()
+
+    def set_message_reply(self, message_sid, response, ttl):
+        """saves the reply to a message for `ttl` seconds, for other instances
+        to find (see dedupe.ReplyCache).
+        """
+        self.replies_collection().document(message_sid).set({
+            'status': 'done', 'response': response,
+            'expires': datetime.now(timezone.utc) + timedelta(seconds=ttl)})
+
+    def purge_message_replies(self):
+        """deletes expired replies and claims. A firestore TTL policy on
+        'expires' does the same thing without this; see the README.
+        """
+        expired = self.replies_collection().where(
+            'expires', '<', datetime.now(timezone.utc)).stream()
+        writes = [(doc.reference, None) for doc in expired]
+        print("purging {} expired message replies".format(len(writes)))
+        self._commit_writes(writes)
+
     def set_phone_session(self, phone, session_dict):
         ref = self.phones_collection().document(phone)
-        data = {'session': session_dict}
+        data = {'session': session_dict, 'updated_at': firestore.SERVER_TIMESTAMP}
         ref.set(data, merge=True)
 
+    def update_phone_session(self, phone, changed, deleted_keys=()):
+        """writes only the changed (and removed) keys of a phone's session.
+        """
+        data = dict(changed)
+        for k in deleted_keys:
+            data[k] = firestore.DELETE_FIELD
+        ref = self.phones_collection().document(phone)
+        ref.set({'session': data, 'updated_at': firestore.SERVER_TIMESTAMP}, merge=True)
+
+    def clear_phone_session(self, phone):
+        """removes a phone's stored session, if it has a record.
+        """
+        try:
+            self.phones_collection().document(phone).update(
+                {'session': firestore.DELETE_FIELD})
+        except exceptions.NotFound:
+            pass
+
     def set_phone_metro(self, phone, metro):
+        """sets a phone's free-text metro, and files the phone under its
+        canonical metro in the metro index.
+
+        What a phone has added to its metro's running totals is kept on the
+        phone's own document, as 'metro_totals', and moved to the new metro in
+        the same transaction that changes its metro_key. `_add_metro_totals`
+        reads and writes the phone's document too, so shops added while the
+        metro changes are counted in exactly one of the two metros.
+        """
         phone = phone.strip("+")
-        data = {
-            'phone': phone,
-            'metro': metro
-        }
+        metro_key, is_new_metro = self._resolve_metro_key(metro)
+        self._init_metro_totals(phone)
         ref = self.phones_collection().document(phone)
-        ref.set(data, merge=True)
+
+        @firestore.transactional
+        def move(transaction):
+            old_doc = ref.get(transaction=transaction)
+            old = old_doc.to_dict() if old_doc.exists else {}
+            old_key = old.get('metro_key')
+            transaction.set(ref, {
+                'phone': phone,
+                'metro': metro,
+                'metro_key': metro_key,
+                'updated_at': firestore.SERVER_TIMESTAMP
+            }, merge=True)
+            metro_data = {'key': metro_key, 'phones': firestore.ArrayUnion([phone])}
+            if is_new_metro:
+                metro_data['name'] = metro
+            transaction.set(self.metros_collection().document(metro_key),
+                            metro_data, merge=True)
+            if old_key != metro_key:
+                totals = old.get('metro_totals', {})
+                transaction.set(*self._metro_increment(metro_key, totals), merge=True)
+                if old_key is not None:
+                    transaction.set(self.metros_collection().document(old_key),
+                                    {'phones': firestore.ArrayRemove([phone])}, merge=True)
+                    transaction.set(*self._metro_increment(old_key, totals, sign=-1),
+                                    merge=True)
+
+        move(self.db.transaction())
+
+    def _resolve_metro_key(self, metro):
+        """finds the canonical metro key for a free-text metro.
+
+        An exact match on the normalized name is a single document read.
+        Otherwise we fuzzy match against the names of the known metros, which
+        is a small collection. Returns (key, is_new).
+        """
+        metro_key = normalize_metro(metro)
+        if self.metros_collection().document(metro_key).get().exists:
+            return metro_key, False
+        best_key, best_ratio = None, 75
+        for doc in self.metros_collection().stream():
+            ratio = fuzz.partial_ratio(doc.to_dict().get('name', doc.id), metro)
+            if ratio > best_ratio:
+                best_key, best_ratio = doc.id, ratio
+        if best_key is not None:
+            return best_key, False
+        return metro_key, True
+
+    def _phone_metro_key(self, phone):
+        doc = self.phones_collection().document(phone).get()
+        if doc.exists:
+            return doc.to_dict().get('metro_key')
+        return None
+
+    def _metro_increment(self, metro_key, totals, sign=1):
+        """a (ref, data) write that adds (or with sign=-1, removes) shop totals
+        from a metro's running aggregates.
+        """
+        data = {k: firestore.Increment(sign * v) for k, v in totals.items()}
+        return (self.metros_collection().document(metro_key), data)
+
+    def _init_metro_totals(self, phone):
+        """starts a phone's 'metro_totals' (see set_phone_metro) from the shops
+        it already has, if it hasn't got them yet. Shops must be added after
+        this, so they're only counted once, by `_add_metro_totals`.
+        """
+        ref = self.phones_collection().document(phone)
+
+        @firestore.transactional
+        def init(transaction):
+            doc = ref.get(transaction=transaction)
+            if doc.exists and 'metro_totals' in doc.to_dict():
+                return
+            shops = self.shops_collection().where('phone', '==', phone).stream(
+                transaction=transaction)
+            totals = metro_totals(pd.DataFrame([r.to_dict() for r in shops]))
+            transaction.set(ref, {'metro_totals': totals}, merge=True)
+
+        init(self.db.transaction())
+
+    def _add_metro_totals(self, phone, totals, sign=1):
+        """adds (or with sign=-1, removes) shop totals to a phone's metro and to
+        the phone's own 'metro_totals', in one transaction, so it can't race
+        with set_phone_metro moving them.
+        """
+        ref = self.phones_collection().document(phone)
+
+        @firestore.transactional
+        def add(transaction):
+            doc = ref.get(transaction=transaction)
+            metro_key = doc.to_dict().get('metro_key') if doc.exists else None
+            if metro_key is not None:
+                transaction.set(*self._metro_increment(metro_key, totals, sign), merge=True)
+            data = {k: firestore.Increment(sign * v) for k, v in totals.items()}
+            transaction.set(ref, {'metro_totals': data}, merge=True)
+
+        add(self.db.transaction())
+
+    def _commit_writes(self, writes, max_workers=1, retries=5):
+        """commits (ref, data) writes in batches of up to BATCH_SIZE.
+
+        data is merged into the document, or the document is deleted if data is
+        None. See `_commit_batches`.
+        """
+        chunks = [writes[i:i + BATCH_SIZE] for i in range(0, len(writes), BATCH_SIZE)]
+        return self._commit_batches(chunks, max_workers, retries)
+
+    def _commit_batches(self, chunks, max_workers=1, retries=5):
+        """commits each list of (ref, data) writes in `chunks` as one batch.
+
+        Batches are committed by up to `max_workers` threads, and retried with
+        exponential backoff on contention or transient errors. A batch that
+        timed out may still have been applied, so one with an Increment in it
+        isn't retried after a DeadlineExceeded, as that could apply it twice.
+        """
+        def commit(chunk):
+            retry_errors = RETRY_ERRORS
+            if any(_has_increment(data) for _, data in chunk):
+                retry_errors = tuple(e for e in RETRY_ERRORS
+                                     if e is not exceptions.DeadlineExceeded)
+            for attempt in range(retries + 1):
+                batch = self.db.batch()
+                for ref, data in chunk:
+                    if data is None:
+                        batch.delete(ref)
+                    else:
+                        batch.set(ref, data, merge=True)
+                try:
+                    batch.commit()
+                    return len(chunk)
+                except retry_errors as e:
+                    if attempt == retries:
+                        raise
+                    print("Retrying batch of {} writes after error: {}".format(len(chunk), e))
+                    time.sleep(0.1 * 2 ** attempt)
+
+        if max_workers == 1 or len(chunks) <= 1:
+            return sum(commit(c) for c in chunks)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return sum(pool.map(commit, chunks))
+
+    def rebuild_metro_aggregates(self):
+        """recomputes every metro's running totals, and each of its phones'
+        'metro_totals', from the phones' shops. Totals are only ever
+        incremented, so use this to backfill or repair them. Run it while
+        nothing else is adding shops.
+        """
+        for doc in self.metros_collection().stream():
+            phones = doc.to_dict().get('phones', [])
+            shops = pd.DataFrame([r.to_dict() for r in self._stream_phones_shops(phones)])
+            writes = [(doc.reference, metro_totals(shops))]
+            for phone in phones:
+                phone_shops = shops[shops['phone'] == phone] if len(shops) > 0 else shops
+                writes.append((self.phones_collection().document(phone),
+                               {'metro_totals': metro_totals(phone_shops)}))
+            self._commit_writes(writes)
+
+    def _stream_phones_shops(self, phones):
+        # firestore caps 'in' queries at 10 values
+        for i in range(0, len(phones), 10):
+            yield from self.shops_collection().where('phone', 'in',
+                                                     phones[i:i + 10]).stream()
+
+    def rebuild_metro_index(self):
+        """files every phone with a metro into the metro index. Used to
+        backfill phones that set their metro before the index existed.
+        """
+        for r in self.phones_collection().stream():
+            r = r.to_dict()
+            if 'metro' in r and 'phone' in r:
+                self.set_phone_metro(str(r['phone']), r['metro'])
+
+    def get_phone_metro_key(self, phone):
+        """the canonical metro key stored for a phone by set_phone_metro, or
+        None if it hasn't set a metro. A phone that set its metro before keys
+        were stored is filed into the metro index now, once.
+        """
+        phone = phone.strip("+")
+        doc = self.phones_collection().document(phone).get()
+        record = doc.to_dict() if doc.exists else {}
+        if record.get('metro_key') is None and record.get('metro') is not None:
+            print("filing phone {} under its metro".format(phone))
+            self.set_phone_metro(phone, record['metro'])
+            return self._phone_metro_key(phone)
+        return record.get('metro_key')
 
     def get_phone_metro(self, phone):
+        """a phone's free-text metro, or None if it hasn't set one.
+        """
         phone = phone.strip("+")
         print("finding metro for phone:", phone)
-        ref = self.phones_collection().document(phone)
-        return ref.get().to_dict()['metro']
+        doc = self.phones_collection().document(phone).get()
+        return doc.to_dict().get('metro') if doc.exists else None
 
     def add_shops(self, df, phone, trim_dupes=True):
         """adds a dataframe of shops to the database.
         """
         phone = phone.strip("+")
-        shops_ref = self.shops_collection()
-        past_shops = shops_ref.where('phone', '==', phone).stream()
-        past_order_numbers = [shop.to_dict()['order_number']
-                              for shop in past_shops]
+        trimmed_df, writes, replaced = self._shop_writes(df, phone, trim_dupes)
+        self._commit_shops({phone: trimmed_df}, writes, replaced)
+        self._update_cached_shops(phone, trimmed_df)
+        return trimmed_df
+
+    def bulk_add_shops(self, df, trim_dupes=True, max_workers=8):
+        """adds shops for many phones at once, e.g. a backfill of re-parsed images.
+
+        `df` needs a 'phone' column. Writes are committed in batches by up to
+        `max_workers` threads. Returns the shops that were added.
+        """
+        added, writes, replaced = {}, [], []
+        for phone, phone_df in df.groupby(df['phone'].astype(str).str.strip("+")):
+            trimmed_df, phone_writes, phone_replaced = self._shop_writes(
+                phone_df, phone, trim_dupes)
+            if len(trimmed_df) > 0:
+                added[phone] = trimmed_df
+                writes.extend(phone_writes)
+                replaced.append(phone_replaced)
+        replaced = pd.concat(replaced) if len(replaced) > 0 else pd.DataFrame()
+        n = self._commit_shops(added, writes, replaced, max_workers=max_workers)
+        added = list(added.values())
+        print("Bulk added {} shops in {} writes".format(sum(len(a) for a in added), n))
+        return pd.concat(added) if len(added) > 0 else pd.DataFrame()
+
+    def _commit_shops(self, added, writes, replaced, max_workers=1):
+        """commits shop writes, then brings the metro totals up to date: each
+        phone's new shops in `added` (a dict of phone to shops) are counted,
+        and the stored shops in `replaced` they overwrite are taken out.
+        """
+        replaced_by_phone = {}
+        if len(replaced) > 0:
+            replaced_by_phone = dict(list(
+                replaced.groupby(replaced['phone'].astype(str).str.strip("+"))))
+        empty = pd.DataFrame()
+
+        def delta(phone):
+            new = metro_totals(added.get(phone, empty))
+            old = metro_totals(replaced_by_phone.get(phone, empty))
+            totals = {k: new[k] - old[k] for k in new}
+            if any(v != 0 for v in totals.values()):
+                self._add_metro_totals(phone, totals)
 
-        batch = self.db.batch()
+        phones = set(added) | set(replaced_by_phone)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            list(pool.map(self._init_metro_totals, phones))
+            n = self._commit_writes(writes, max_workers=max_workers)
+            list(pool.map(delta, phones))
+        return n
+
+    def _shop_writes(self, df, phone, trim_dupes=True):
+        """trims a phone's new shops and builds the (ref, data) writes for them.
+
+        Returns the shops, the writes, and the stored shops they'll overwrite.
+        Those are only looked up without `trim_dupes`, since otherwise the
+        phone's stored shops have been trimmed out.
+        """
         if trim_dupes:
-            order_numbers_keep = [on for on in df.order_number if on not in
-                                  past_order_numbers]
-            trimmed_df = df[df['order_number'].isin(order_numbers_keep)]
-            trimmed_df = trimmed_df.drop_duplicates(subset='order_number',
-                                                    keep='first', inplace=False)
+            trimmed_df = df.drop_duplicates(subset='order_number',
+                                            keep='first', inplace=False)
+            past_order_numbers = self._existing_order_numbers(
+                trimmed_df['order_number'], phone)
+            trimmed_df = trimmed_df[~trimmed_df['order_number'].isin(past_order_numbers)]
         else:
             trimmed_df = df
 
         # drop any with no order number
         trimmed_df = trimmed_df[trimmed_df["order_number"] != ""]
+        # shops are looked up by the phone without its '+'
+        trimmed_df = trimmed_df.assign(phone=phone)
 
         trimmed_df['order_pay'] = pd.to_numeric(trimmed_df['order_pay'])
         trimmed_df['order_total'] = pd.to_numeric(trimmed_df['order_total'])
@@ -80,13 +513,36 @@ class FirestoreBackend():
         trimmed_df['is_v1'] = abs(v1_pay - trimmed_df["order_pay"]) < 0.05
 
         records = trimmed_df.to_dict(orient='records')
-        for r in records:
-            if 'order_number' in r and r['order_number'] != "":
-                ref = self.shops_collection().document(r['order_number'])
-                ref.set(r, merge=True)
+        writes = [(self.shops_collection().document(r['order_number']),
+                   dict(r, ingested_at=firestore.SERVER_TIMESTAMP))
+                  for r in records
+                  if 'order_number' in r and r['order_number'] != ""]
+        replaced = pd.DataFrame()
+        if not trim_dupes and len(writes) > 0:
+            replaced = pd.DataFrame([snap.to_dict() for snap in
+                                     self.db.get_all([ref for ref, _ in writes])
+                                     if snap.exists])
+        return trimmed_df, writes, replaced
 
-        batch.commit()
-        return trimmed_df
+    def _existing_order_numbers(self, order_numbers, phone):
+        """the subset of `order_numbers` this phone has already sent us.
+
+        Shops are keyed by order number, so this is a batched lookup of just
+        those documents rather than a scan of the phone's history. If the
+        phone's shops are already in the request cache we use those instead.
+        """
+        order_numbers = set(on for on in order_numbers if on != "")
+        cache = getattr(self._local, 'shops', None)
+        if cache is not None and phone in cache:
+            past_shops = cache[phone]
+            if len(past_shops) == 0:
+                return set()
+            return order_numbers & set(past_shops['order_number'])
+        refs = [self.shops_collection().document(on) for on in order_numbers]
+        if len(refs) == 0:
+            return set()
+        return set(snap.id for snap in self.db.get_all(refs, field_paths=['phone'])
+                   if snap.exists and snap.to_dict().get('phone') == phone)
 
     def is_new_phone(self, phone):
         phone = phone.strip("+")
@@ -104,120 +560,378 @@ class FirestoreBackend():
 
     def get_phone_shops(self, phone):
         phone = phone.strip("+")
-        phone_ref = self.shops_collection()
+        shops = self._phone_shops_all(phone)
         # ignore delivery_only shops (for now)
-        phone_records = phone_ref.where('phone', '==', phone).where('delivery_only', '==',
-                                                                    False).stream()
-        return pd.DataFrame([r.to_dict() for r in phone_records])
+        if 'delivery_only' not in shops:
+            return pd.DataFrame()
+        return shops[shops['delivery_only'] == False]
+
+    def claim_lease(self, ref, data=None):
+        """claims the job document at `ref` for this instance, in a transaction,
+        merging in `data`. Returns False without claiming it if the job's lease
+        (see `leased`) hasn't run out yet, i.e. it's still running somewhere.
+        """
+        @firestore.transactional
+        def claim(transaction):
+            now = datetime.now(timezone.utc)
+            doc = ref.get(transaction=transaction)
+            lease_expires = doc.to_dict().get('lease_expires') if doc.exists else None
+            if lease_expires is not None and lease_expires > now:
+                return False
+            transaction.set(ref, dict(
+                data or {}, owner=self.instance_id,
+                lease_expires=now + timedelta(seconds=LEASE_SECONDS)), merge=True)
+            return True
 
-    def delete_phone_records(self, phone):
+        return claim(self.db.transaction())
+
+    @contextmanager
+    def leased(self, ref):
+        """keeps this instance's lease on the job document at `ref` alive, with a
+        heartbeat, while the job runs.
+        """
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(LEASE_SECONDS / 3):
+                try:
+                    # update, not set, so a job that deletes its document when
+                    # it's done doesn't get it back
+                    ref.update({'lease_expires': datetime.now(timezone.utc) +
+                                timedelta(seconds=LEASE_SECONDS)})
+                except exceptions.NotFound:
+                    return
+
+        threading.Thread(target=heartbeat, daemon=True).start()
+        try:
+            yield
+        finally:
+            stop.set()
+
+    def delete_phone_records(self, phone, background=False):
+        """deletes every shop and phone record for a phone.
+
+        Progress is recorded in the deletions collection, so a delete that is
+        interrupted (e.g. the instance shuts down) can be finished with
+        `resume_deletions`. The delete is leased (see `claim_lease`), so only
+        one instance runs it at a time. With background=True this returns
+        right away and deletes in a separate thread.
+        """
         phone = phone.strip("+")
+        self._invalidate_cached_shops(phone)
+        claimed = self.claim_lease(self.deletions_collection().document(phone), {
+            'phone': phone,
+            'status': 'running',
+            'started': firestore.SERVER_TIMESTAMP})
+        if not claimed:
+            print("delete for phone {} is already running".format(phone))
+            return
+        if background:
+            threading.Thread(target=self._delete_phone_records, args=(phone,),
+                             daemon=True).start()
+        else:
+            self._delete_phone_records(phone)
+
+    def _delete_phone_records(self, phone, max_workers=8):
+        progress_ref = self.deletions_collection().document(phone)
+        with self.leased(progress_ref):
+            self._delete_leased_phone_records(phone, progress_ref, max_workers)
+
+    def _delete_leased_phone_records(self, phone, progress_ref, max_workers=8):
         print("deleting all records with phone:", phone)
-        shop_records = self.shops_collection().where("phone", "==",
-                                                     phone).stream()
-        for record in shop_records:
-            record.reference.delete()
-        phone_records = self.phones_collection().where("phone", "==",
-                                                       phone).stream()
-        for record in phone_records:
-            record.reference.delete()
+        # the phone's totals come out of its metro once its shops are gone
+        self._init_metro_totals(phone)
+        shop_records = list(self.shops_collection().where("phone", "==",
+                                                          phone).stream())
+        # each batch deletes its shops and counts them as deleted, so an
+        # interrupted delete can just start over with whatever shops are left.
+        chunk_size = BATCH_SIZE - 1
+        chunks = []
+        for i in range(0, len(shop_records), chunk_size):
+            records = shop_records[i:i + chunk_size]
+            writes = [(r.reference, None) for r in records]
+            writes.append((progress_ref, {'n_deleted': firestore.Increment(len(records))}))
+            chunks.append(writes)
+        self._commit_batches(chunks, max_workers=max_workers)
+        # and the record of each broadcast sent to it
+        self._commit_writes([(b.collection('recipients').document(phone), None)
+                             for b in self.broadcasts_collection().list_documents()])
+
+        ref = self.phones_collection().document(phone)
+        other_refs = [r.reference for r in
+                      self.phones_collection().where("phone", "==", phone).stream()
+                      if r.id != phone]
+
+        # takes the phone's totals out of its metro in the same transaction
+        # that deletes the phone, so it happens exactly once
+        @firestore.transactional
+        def finish(transaction):
+            doc = ref.get(transaction=transaction)
+            record = doc.to_dict() if doc.exists else {}
+            metro_key = record.get('metro_key')
+            if metro_key is not None:
+                transaction.set(*self._metro_increment(
+                    metro_key, record.get('metro_totals', {}), sign=-1), merge=True)
+                transaction.set(self.metros_collection().document(metro_key),
+                                {'phones': firestore.ArrayRemove([phone])}, merge=True)
+            transaction.delete(ref)
+            for other_ref in other_refs:
+                transaction.delete(other_ref)
+            # nothing of the phone's is kept once it's gone, including this record
+            transaction.delete(progress_ref)
+
+        finish(self.db.transaction())
+        self._invalidate_cached_shops(phone)
+        print("deleted {} shops for phone: {}".format(len(shop_records), phone))
+
+    def resume_deletions(self, background=True):
+        """restarts any deletes that didn't finish, unless they're still running
+        here or on another instance, i.e. their lease hasn't run out.
+        """
+        running = self.deletions_collection().where('status', '==', 'running').stream()
+        for doc in running:
+            if not _lease_expired(doc.to_dict()):
+                continue
+            phone = doc.to_dict()['phone']
+            print("resuming delete for phone:", phone)
+            self.delete_phone_records(phone, background=background)
+
+    def start_broadcast(self, broadcast_id, message, admin_phone):
+        """records that a broadcast is running, so it can be resumed (see
+        running_broadcasts) if the instance sending it goes away. The
+        broadcast is leased (see `claim_lease`); returns False if it's still
+        running on another instance.
+        """
+        return self.claim_lease(self.broadcasts_collection().document(broadcast_id), {
+            'message': message, 'admin_phone': admin_phone, 'status': 'running',
+            'started_at': firestore.SERVER_TIMESTAMP})
+
+    def broadcast_lease(self, broadcast_id):
+        """keeps this instance's lease on a broadcast alive while it sends.
+        """
+        return self.leased(self.broadcasts_collection().document(broadcast_id))
+
+    def finish_broadcast(self, broadcast_id, counts):
+        self.broadcasts_collection().document(broadcast_id).set(
+            dict(counts, status='done', lease_expires=None,
+                 finished_at=firestore.SERVER_TIMESTAMP),
+            merge=True)
+
+    def fail_broadcast(self, broadcast_id, error):
+        """marks a broadcast as failed, so it isn't resumed. Sending it again
+        picks up where it left off.
+        """
+        self.broadcasts_collection().document(broadcast_id).set(
+            {'status': 'failed', 'error': error, 'lease_expires': None,
+             'finished_at': firestore.SERVER_TIMESTAMP},
+            merge=True)
+
+    def running_broadcasts(self):
+        """(id, broadcast) for each broadcast that didn't finish, and isn't
+        still running here or on another instance, i.e. its lease has run out.
+        """
+        running = self.broadcasts_collection().where('status', '==', 'running').stream()
+        return [(doc.id, doc.to_dict()) for doc in running
+                if _lease_expired(doc.to_dict())]
+
+    def get_broadcast_handled(self, broadcast_id):
+        """the numbers a broadcast has been sent to, or started sending to.
+        """
+        recipients = (self.broadcasts_collection().document(broadcast_id)
+                      .collection('recipients')
+                      .where('status', 'in', ['sending', 'sent']).stream())
+        return set(doc.id for doc in recipients)
+
+    def set_broadcast_status(self, broadcast_id, phone, status, error=None):
+        data = {'status': status, 'updated_at': firestore.SERVER_TIMESTAMP}
+        if error is not None:
+            data['error'] = error
+        (self.broadcasts_collection().document(broadcast_id)
+         .collection('recipients').document(phone).set(data))
 
     def get_v1_shops(self, phone):
-        v1_shops = self.shops_collection().where('phone', '==',
-                                                 phone).where('is_v1', '==',
-                                                              True).where('delivery_only',
-                                                                          '==', False).stream()
-        return pd.DataFrame([r.to_dict() for r in v1_shops])
+        shops = self.get_phone_shops(phone)
+        if 'is_v1' not in shops:
+            return pd.DataFrame()
+        return shops[shops['is_v1'] == True]
 
     def get_v2_shops(self, phone):
-        v2_shops = self.shops_collection().where('phone', '==',
-                                                 phone).where('is_v1', '==',
-                                                              False).where('delivery_only',
-                                                                           '==', False).stream()
-        return pd.DataFrame([r.to_dict() for r in v2_shops])
+        shops = self.get_phone_shops(phone)
+        if 'is_v1' not in shops:
+            return pd.DataFrame()
+        return shops[shops['is_v1'] == False]
+
+    def phone_stats(self, phone):
+        """pay, tip and algorithm statistics for a phone, from one read of its shops.
+        does not include delivery_only shops. See `shop_stats`.
+        """
+        return shop_stats(self.get_phone_shops(phone))
 
     def average_pay_v1(self, phone):
         """calculates average pay for a given phone if they had only the v1 algorithm.
         """
-        v1_shops = self.get_v1_shops(phone)
-        if len(v1_shops) != 0:
-            return (len(v1_shops), v1_shops['order_pay'].mean())
-        else:
-            return (0, None)
+        stats = self.phone_stats(phone)
+        return (stats['n_v1'], stats['mean_pay_v1'])
 
     def is_likely_v1_algo_p(self, phone):
         """Returns true if over 3/4 of this phone's shops are from the v1 algo
         """
-        v1_shops = self.get_v1_shops(phone)
-        if self.n_records(phone) == 0:
-            return None
-        else:
-            pct_v1 = len(v1_shops) / self.n_records(phone)
-            return pct_v1 > 0.75
+        return self.phone_stats(phone)['likely_v1']
 
     def average_pay_v2(self, phone):
         """calculates average pay for a given phone using only shops that aren't consistent
         with the v1 pay algorithm.
         does not include delivery_only shops.
         """
-        v2_shops = self.get_v2_shops(phone)
-        if len(v2_shops) != 0:
-            return (len(v2_shops), v2_shops['order_pay'].mean())
-        else:
-            return (0, None)
+        stats = self.phone_stats(phone)
+        return (stats['n_v2'], stats['mean_pay_v2'])
 
     def average_pay_if_v1(self, phone):
         """calculates average pay for a given phone if all their shops were under v1.
         does not include delivery_only shops.
         """
-        shops = self.get_phone_shops(phone)
-        return (shops["order_total"] * 0.075 + 5).mean()
+        return self.phone_stats(phone)['mean_pay_if_v1']
 
     def average_pay_true(self, phone):
         """calculates "true" average pay for a given phone #, from 
         all actual given shops.
         """
-        mean_pay = self.get_phone_shops(phone)["order_pay"].mean()
-        return mean_pay
+        return self.phone_stats(phone)['mean_pay_true']
 
     def average_tips(self, phone):
         """calculate average tips for each shop
         """
-        records = self.get_phone_shops(phone)
-        avg_tips = records["tip"].mean()
-        tip_pct = (records["tip"] / records["total_pay"]).mean()
-        return {"mean_amt": avg_tips, "mean_pct": tip_pct}
+        stats = self.phone_stats(phone)
+        return {"mean_amt": stats['mean_tip'], "mean_pct": stats['mean_tip_pct']}
 
     def v1_v2_total_pay_difference(self, phone):
-        records = self.get_phone_shops(phone)
-        v1_pay = ((records["order_total"] * 0.075) + 5).sum()
-        true_pay = records["order_pay"].sum()
-        return v1_pay - true_pay
-
-    def get_metro_stats(self, metro):
-        metro_records = self.phones_collection().stream()
-        metro_records = [r.to_dict() for r in metro_records]
-        metro_records = [r for r in metro_records if 'metro' in r]
-        metro_phones = [str(r['phone']) for r in metro_records if
-                        fuzz.partial_ratio(r['metro'], metro) > 75]
+        return self.phone_stats(phone)['total_pay_difference']
+
+    def get_metro_stats(self, metro_key):
+        """pay statistics for a metro, read from its running totals. Takes the
+        canonical key that set_phone_metro stored for a phone (see
+        get_phone_metro_key), so this is a single document read.
+        """
+        if metro_key is None:
+            return None
+        metro_doc = self.metros_collection().document(metro_key).get()
+        if not metro_doc.exists:
+            print("no metro found with key", metro_key)
+            return None
+        metro_doc = metro_doc.to_dict()
+        metro_phones = metro_doc.get('phones', [])
         print(">>> metro phones:", metro_phones)
         if len(metro_phones) < 3:
             print("not enough other shoppers with that metro")
             return None
-        metro_shops = self.shops_collection().where('phone', 'in',
-                                                    metro_phones).stream()
-        metro_shops = pd.DataFrame([r.to_dict() for r in metro_shops])
-        if len(metro_shops) < 5:
+        if metro_doc.get('n_records', 0) < 5:
             print("not enough other shops in that metro")
             return None
-        avg_metro_pay = metro_shops['order_pay'].mean()
 
-        v1_shops = metro_shops[metro_shops['is_v1']]['order_pay']
-        avg_pay_v1 = v1_shops.mean()
+        def ratio(num, denom):
+            n = metro_doc.get(denom, 0)
+            return metro_doc.get(num, 0) / n if n > 0 else None
+
+        return {"n_records": metro_doc['n_records'],
+                "avg_pay_true": ratio('sum_order_pay', 'n_order_pay'),
+                "avg_pay_v1": ratio('sum_order_pay_v1', 'n_order_pay_v1'),
+                'pct_v1': ratio('n_v1', 'n_records'),
+                "avg_tips": ratio('sum_tip', 'n_tip'),
+                "tip_pct": ratio('sum_tip_pct', 'n_tip_pct')}
+
+
+def normalize_metro(metro):
+    """turns a free-text metro into a document key, e.g. ' B. City ' -> 'b-city'
+    """
+    return "-".join(receipts.strip_punc(metro.lower()).split()) or "unknown"
+
+
+def metro_totals(shops):
+    """the counts and sums kept as running totals on each metro document.
+
+    Means are recovered by dividing a sum by its count, so each sum is paired
+    with the number of non-missing values that went into it.
+    """
+    totals = {'n_records': len(shops), 'n_v1': 0,
+              'n_order_pay': 0, 'sum_order_pay': 0.0,
+              'n_order_pay_v1': 0, 'sum_order_pay_v1': 0.0,
+              'n_tip': 0, 'sum_tip': 0.0,
+              'n_tip_pct': 0, 'sum_tip_pct': 0.0}
+    if len(shops) == 0:
+        return totals
+    order_pay = _numeric_column(shops, 'order_pay')
+    tip = _numeric_column(shops, 'tip')
+    tip_pct = tip / _numeric_column(shops, 'total_pay')
+    tip_pct = tip_pct[np.isfinite(tip_pct)]
+    is_v1 = _column(shops, 'is_v1') == True
+    totals.update({'n_v1': int(is_v1.sum()),
+                   'n_order_pay': int(order_pay.count()),
+                   'sum_order_pay': float(order_pay.sum()),
+                   'n_order_pay_v1': int(order_pay[is_v1].count()),
+                   'sum_order_pay_v1': float(order_pay[is_v1].sum()),
+                   'n_tip': int(tip.count()),
+                   'sum_tip': float(tip.sum()),
+                   'n_tip_pct': int(tip_pct.count()),
+                   'sum_tip_pct': float(tip_pct.sum())})
+    return totals
+
+
+def _lease_expired(job):
+    lease_expires = job.get('lease_expires')
+    return lease_expires is None or lease_expires <= datetime.now(timezone.utc)
+
+
+def _has_increment(data):
+    if isinstance(data, dict):
+        return any(_has_increment(v) for v in data.values())
+    return isinstance(data, firestore.Increment)
+
+
+def _column(shops, name):
+    """a column of shops, or all missing values if no shop has it.
+    """
+    if name in shops:
+        return shops[name]
+    return pd.Series(np.nan, index=shops.index)
+
+
+def _numeric_column(shops, name):
+    return pd.to_numeric(_column(shops, name), errors='coerce')
+
+
+def _mean_or_none(x):
+    return x.mean() if len(x) > 0 else None
 
-        pct_v1 = len(v1_shops) / len(metro_shops)
 
-        avg_tips = metro_shops['tip'].mean()
-        tip_pct = (metro_shops['tip'] / metro_shops['total_pay']).mean()
+def shop_stats(shops):
+    """computes every pay statistic for a dataframe of shops in one pass.
 
-        return {"n_records": len(metro_shops), "avg_pay_true": avg_metro_pay, "avg_pay_v1": avg_pay_v1, 'pct_v1': pct_v1, "avg_tips": avg_tips, "tip_pct": tip_pct}
+    v1 pay is what the shop would have paid under the original algorithm:
+    7.5% of the order total, plus $5. Means over an empty subset are None.
+    """
+    n = len(shops)
+    if n == 0:
+        return {'n_records': 0, 'n_v1': 0, 'n_v2': 0,
+                'mean_pay_true': None, 'mean_pay_v1': None, 'mean_pay_v2': None,
+                'mean_pay_if_v1': None, 'total_pay_difference': 0,
+                'mean_tip': None, 'mean_tip_pct': None,
+                'pct_v1': None, 'likely_v1': None}
+    order_pay = _numeric_column(shops, 'order_pay')
+    tip = _numeric_column(shops, 'tip')
+    pay_if_v1 = _numeric_column(shops, 'order_total') * 0.075 + 5
+    is_v1 = _column(shops, 'is_v1') == True
+    is_v2 = _column(shops, 'is_v1') == False
+    n_v1 = int(is_v1.sum())
+    pct_v1 = n_v1 / n
+    return {'n_records': n,
+            'n_v1': n_v1,
+            'n_v2': int(is_v2.sum()),
+            'mean_pay_true': order_pay.mean(),
+            'mean_pay_v1': _mean_or_none(order_pay[is_v1]),
+            'mean_pay_v2': _mean_or_none(order_pay[is_v2]),
+            'mean_pay_if_v1': pay_if_v1.mean(),
+            'total_pay_difference': pay_if_v1.sum() - order_pay.sum(),
+            'mean_tip': tip.mean(),
+            'mean_tip_pct': (tip / _numeric_column(shops, 'total_pay')).mean(),
+            'pct_v1': pct_v1,
+            'likely_v1': pct_v1 > 0.75}
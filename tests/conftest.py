@@ -0,0 +1,51 @@
+import pytest
+
+
+class FakeBackend():
+    """stands in for FirestoreBackend's reply, broadcast and session storage in
+    tests that don't need firestore.
+    """
+
+    def __init__(self):
+        self.replies = {}
+        self.statuses = {}
+        self.sessions = {}
+        self.fail_writes = False
+
+    def get_phone_session(self, phone):
+        return self.sessions.get(phone)
+
+    def update_phone_session(self, phone, changed, deleted_keys=()):
+        if self.fail_writes:
+            raise IOError("write failed")
+        session = self.sessions.setdefault(phone, {})
+        session.update(changed)
+        for k in deleted_keys:
+            session.pop(k, None)
+
+    def get_message_reply(self, message_sid):
+        return self.replies.get(message_sid)
+
+    def set_message_reply(self, message_sid, response, ttl):
+        self.replies[message_sid] = response
+
+    def claim_message(self, message_sid, timeout):
+        if message_sid in self.replies:
+            return self.replies[message_sid]
+        self.replies[message_sid] = ''
+        return None
+
+    def release_message(self, message_sid):
+        self.replies.pop(message_sid, None)
+
+    def get_broadcast_handled(self, broadcast_id):
+        return set(phone for (b, phone), status in self.statuses.items()
+                   if b == broadcast_id and status in ('sending', 'sent'))
+
+    def set_broadcast_status(self, broadcast_id, phone, status, error=None):
+        self.statuses[(broadcast_id, phone)] = status
+
+
+@pytest.fixture
+def backend():
+    return FakeBackend()
@@ -0,0 +1,43 @@
+import time
+
+from shipt.broadcast import RateLimiter, broadcast_id, run_broadcast
+
+
+def test_rate_limiter_limits_rate():
+    limiter = RateLimiter(rate=50)
+    start = time.time()
+    for _ in range(11):
+        limiter.acquire()
+    assert time.time() - start >= 0.19
+
+
+def test_broadcast_id_depends_on_message_and_day():
+    assert broadcast_id("hi", "2020-10-01") == broadcast_id("hi", "2020-10-01")
+    assert broadcast_id("hi", "2020-10-01") != broadcast_id("hey", "2020-10-01")
+    assert broadcast_id("hi", "2020-10-01") != broadcast_id("hi", "2020-10-02")
+
+
+def test_broadcast_records_failures(backend):
+    sent = []
+
+    def send(number, message):
+        if number == "2":
+            raise ValueError("invalid number")
+        sent.append(number)
+
+    counts = run_broadcast(backend, "b", "hi", ["1", "2", "3"], send, rate=100)
+    assert sorted(sent) == ["1", "3"]
+    assert counts['sent'] == 2
+    assert counts['failed'] == 1
+    assert backend.statuses[("b", "2")] == 'failed'
+
+
+def test_resumed_broadcast_skips_sent_numbers(backend):
+    backend.set_broadcast_status("b", "1", 'sent')
+    # cut off mid-send, so it may have gone out
+    backend.set_broadcast_status("b", "3", 'sending')
+    sent = []
+    counts = run_broadcast(backend, "b", "hi", ["1", "2", "2", "3"],
+                           lambda number, message: sent.append(number), rate=100)
+    assert sent == ["2"]
+    assert counts['skipped'] == 2
@@ -0,0 +1,58 @@
+import time
+import threading
+
+from shipt.dedupe import ReplyCache
+
+
+def test_returns_saved_reply():
+    replies = ReplyCache(ttl=60)
+    assert replies.get("sid0") is None
+    replies.set("sid0", "<Response/>")
+    assert replies.get("sid0") == "<Response/>"
+
+
+def test_replies_expire():
+    replies = ReplyCache(ttl=0.05)
+    replies.set("sid0", "<Response/>")
+    time.sleep(0.1)
+    assert replies.get("sid0") is None
+
+
+def test_bounded_entries():
+    replies = ReplyCache(ttl=60, max_entries=2)
+    for n in range(3):
+        replies.set("sid{}".format(n), str(n))
+    assert replies.get("sid0") is None
+    assert replies.get("sid2") == "2"
+
+
+def test_disabled_without_ttl():
+    replies = ReplyCache(ttl=0)
+    replies.set("sid0", "<Response/>")
+    assert replies.get("sid0") is None
+
+
+def test_shares_replies_through_backend(backend):
+    ReplyCache(ttl=60, backend=backend).set("sid0", "<Response/>")
+    assert ReplyCache(ttl=60, backend=backend).get("sid0") == "<Response/>"
+
+
+def test_retry_waits_for_first_attempt():
+    replies = ReplyCache(ttl=60)
+    assert replies.claim("sid0") == (True, None)
+    threading.Timer(0.05, replies.set, ("sid0", "<Response/>")).start()
+    assert replies.claim("sid0") == (False, "<Response/>")
+
+
+def test_released_message_is_handled_again():
+    replies = ReplyCache(ttl=60, wait=0.01)
+    assert replies.claim("sid0") == (True, None)
+    assert replies.claim("sid0") == (False, None)
+    replies.release("sid0")
+    assert replies.claim("sid0") == (True, None)
+
+
+def test_claims_are_shared_through_backend(backend):
+    assert ReplyCache(ttl=60, backend=backend).claim("sid0") == (True, None)
+    # still being handled on the first instance
+    assert ReplyCache(ttl=60, backend=backend).claim("sid0") == (False, None)
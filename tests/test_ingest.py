@@ -0,0 +1,35 @@
+from shipt.ingest import LocalQueue
+
+
+def test_queue_runs_jobs():
+    done = []
+    q = LocalQueue(done.append, workers=2)
+    for n in range(5):
+        assert q.enqueue("sid{}".format(n), n)
+    q.join()
+    assert sorted(done) == [0, 1, 2, 3, 4]
+
+
+def test_queue_skips_repeated_keys():
+    done = []
+    q = LocalQueue(done.append, workers=1)
+    assert q.enqueue("sid0", "first")
+    assert not q.enqueue("sid0", "retry")
+    assert q.enqueue(None, "no key")
+    q.join()
+    assert done == ["first", "no key"]
+
+
+def test_queue_survives_failing_jobs():
+    done = []
+
+    def handler(job):
+        if job == "bad":
+            raise ValueError(job)
+        done.append(job)
+
+    q = LocalQueue(handler, workers=1)
+    q.enqueue("sid0", "bad")
+    q.enqueue("sid1", "good")
+    q.join()
+    assert done == ["good"]
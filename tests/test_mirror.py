@@ -0,0 +1,41 @@
+import os
+import pytest
+
+from shipt.mirror import LocalBucket, mirror_blobs
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    root = tmp_path / "bucket"
+    (root / "sub").mkdir(parents=True)
+    (root / "a.png").write_bytes(b"aaaa")
+    (root / "sub" / "b.png").write_bytes(b"bbbbbb")
+    return str(root)
+
+
+def test_mirrors_all_blobs(bucket, tmp_path):
+    dest = str(tmp_path / "images")
+    counts = mirror_blobs(LocalBucket(bucket).list_blobs(), dest, workers=2)
+    assert counts == {'downloaded': 2, 'skipped': 0, 'failed': 0}
+    with open(os.path.join(dest, "sub", "b.png"), 'rb') as f:
+        assert f.read() == b"bbbbbb"
+
+
+def test_skips_blobs_already_mirrored(bucket, tmp_path):
+    dest = str(tmp_path / "images")
+    mirror_blobs(LocalBucket(bucket).list_blobs(), dest)
+    counts = mirror_blobs(LocalBucket(bucket).list_blobs(), dest)
+    assert counts == {'downloaded': 0, 'skipped': 2, 'failed': 0}
+
+
+def test_redownloads_changed_blobs(bucket, tmp_path):
+    dest = str(tmp_path / "images")
+    mirror_blobs(LocalBucket(bucket).list_blobs(), dest)
+    # same size, different contents
+    with open(os.path.join(bucket, "a.png"), 'wb') as f:
+        f.write(b"zzzz")
+    os.remove(os.path.join(dest, ".mirror-checkpoint.json"))
+    counts = mirror_blobs(LocalBucket(bucket).list_blobs(), dest)
+    assert counts == {'downloaded': 1, 'skipped': 1, 'failed': 0}
+    with open(os.path.join(dest, "a.png"), 'rb') as f:
+        assert f.read() == b"zzzz"
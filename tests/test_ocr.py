@@ -0,0 +1,35 @@
+import os
+
+from shipt.ocr import OCRCache, cache_key
+
+
+def test_cache_key_depends_on_version():
+    assert cache_key(b"img", "rows", "1") == cache_key(b"img", "rows", "1")
+    assert cache_key(b"img", "rows", "1") != cache_key(b"img", "rows", "2")
+    assert cache_key(b"img", "rows", "1") != cache_key(b"img", "text", "1")
+
+
+def test_cache_evicts_least_recently_used():
+    cache = OCRCache(max_entries=2, max_bytes=1024, directory=None)
+    cache.set("a", [{"order_number": "1"}])
+    cache.set("b", "text")
+    cache.get("a")
+    cache.set("c", "more text")
+    assert cache.get("b") is None
+    assert cache.get("a") == [{"order_number": "1"}]
+    assert cache.get("c") == "more text"
+
+
+def test_cache_bounded_by_bytes():
+    cache = OCRCache(max_entries=100, max_bytes=20, directory=None)
+    cache.set("a", "x" * 10)
+    cache.set("b", "y" * 10)
+    assert cache.get("a") is None
+    assert cache.nbytes <= 20
+
+
+def test_cache_shared_on_disk(tmp_path):
+    first = OCRCache(directory=str(tmp_path))
+    first.set("abcd", [{"tip": 5.0}])
+    second = OCRCache(directory=str(tmp_path))
+    assert second.get("abcd") == [{"tip": 5.0}]
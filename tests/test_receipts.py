@@ -1,9 +1,15 @@
 from twilio.rest import Client
 import pandas as pd
+import numpy as np
 import os
 import pytest
 
-from shipt.receipts import receipt_to_df
+from shipt.receipts import receipt_to_df, preprocess, find_card_regions, choose_scale, MAX_SCALE
+from shipt.receipts import parse_receipt_text, parse_money, reconcile, words_to_df
+from shipt.receipts import reocr_amounts, cache_version
+from shipt import receipts
+from shipt import ocr
+import cv2
 from google.cloud import storage
 
 
@@ -224,3 +230,145 @@ def test_receipt_cutoff_ordernumber(example_receipts):
     assert res_dict[1]["order_number"] != ''
     # make sure we get all shops in the long screenshot
     assert len(res_dict) == 7
+
+
+def test_cropped_cards_parse_like_full_image(example_receipts):
+    for receipt in example_receipts:
+        res = receipt_to_df(receipt['filename'], crop=True)
+        res_dict = res.to_dict(orient='records')
+        data = receipt['data']
+        assert len(res_dict) == len(data)
+        for n, shop in enumerate(res_dict):
+            for k, v in data[n].items():
+                assert data[n][k] == shop[k]
+
+
+def test_card_regions_skip_blank_space(example_receipts):
+    for receipt in example_receipts:
+        gray = preprocess(receipt['filename'])
+        regions = find_card_regions(gray)
+        assert len(regions) > 0
+        assert sum(w * h for x, y, w, h in regions) < gray.shape[0] * gray.shape[1]
+
+
+def test_scale_shrinks_for_larger_screenshots(example_receipts):
+    for receipt in example_receipts:
+        gray = cv2.cvtColor(cv2.imread(receipt['filename']), cv2.COLOR_BGR2GRAY)
+        scale, _ = choose_scale(gray)
+        bigger = cv2.resize(gray, None, fx=2, fy=2, interpolation=cv2.INTER_CUBIC)
+        bigger_scale, _ = choose_scale(bigger)
+        assert bigger_scale <= scale <= MAX_SCALE
+
+
+card_text = """Delivery Window
+03/02: 2PM to 3PM
+Delivered Today, 2:15 PM
+Order #50859325 » $56.00 On Time
+Order Pay $9.43
+Tip $0.00
+Total Pay $9.43
+
+Delivery Window 03/05: 11AM to 12PM
+Order #50490162 $69.44 Late
+Order Pay $1,021
+Tip $6.48
+Promo Pay $0.50
+Total Pay $17.19
+"""
+
+
+def test_parses_card_text():
+    shops = parse_receipt_text(card_text, "cards.png")
+    assert len(shops) == 2
+    assert shops[0]['order_number'] == "50859325"
+    assert shops[0]['order_total'] == 56.00
+    assert shops[0]['order_pay'] == 9.43
+    assert shops[0]['late'] is False
+    assert shops[0]['delivery_window_start'] == "2PM"
+    assert shops[1]['late'] is True
+    assert shops[1]['promo_pay'] == 0.5
+    assert shops[1]['delivery_date'] == "03/05"
+
+
+def test_parse_money():
+    assert parse_money("$1,234.56") == 1234.56
+    assert parse_money("S9.43") == 9.43
+    assert parse_money("$") is None
+    assert parse_money("Pay") is None
+
+
+def test_reconcile_fixes_amounts():
+    df = reconcile(pd.DataFrame([
+        # missed decimal point in the order pay
+        {"order_number": "1", "order_pay": 943.0, "tip": 0.0, "promo_pay": 0, "total_pay": 9.43},
+        # total pay misread as too big
+        {"order_number": "2", "order_pay": 10.21, "tip": 6.48, "promo_pay": 0, "total_pay": 76.69},
+        # redacted order number
+        {"order_number": "XXXXXXXX", "order_pay": 9.43, "tip": 5.0, "promo_pay": 0,
+         "total_pay": 14.43, "delivery_date": "03/02/2020"},
+        # couldn't read the total pay, so leave it alone
+        {"order_number": "4", "order_pay": 943.0, "tip": 0.0, "promo_pay": 0, "total_pay": None},
+    ]))
+    assert list(df["order_pay"])[:3] == [9.43, 10.21, 9.43]
+    assert df["order_pay"][3] == 943.0
+    assert df["total_pay"][1] == 16.69
+    assert df["order_number"][2] == "51402"
+
+
+def test_words_to_df_keeps_confidences():
+    lines = [[{'text': t, 'conf': 95.0, 'box': [0, 0, 10, 10]} for t in line.split()]
+             for line in card_text.split("\n")]
+    df = words_to_df(lines, None, "cards.png")
+    assert len(df) == 2
+    assert list(df["order_pay"]) == [9.43, 10.21]
+    assert list(df["order_pay_conf"]) == [95.0, 95.0]
+    assert np.isnan(df["promo_pay_conf"][0])
+
+
+def test_unreadable_total_ends_card_at_next_order():
+    text = card_text.replace("Total Pay $9.43", "T0tal Pay $9.43")
+    shops = parse_receipt_text(text, "cards.png")
+    assert len(shops) == 2
+    assert shops[0]['order_number'] == "50859325"
+    assert shops[0].get('total_pay') is None
+    assert shops[0]['delivery_window_start'] == "2PM"
+    assert shops[1]['order_number'] == "50490162"
+    assert shops[1]['delivery_date'] == "03/05"
+    assert shops[1]['total_pay'] == 17.19
+
+
+def test_skips_order_pay_without_amount():
+    text = card_text.replace("Order Pay $9.43", "Order Pay")
+    shops = parse_receipt_text(text, "cards.png")
+    assert len(shops) == 2
+    assert shops[0]['order_number'] == "50859325"
+    assert shops[0].get('order_pay') is None
+    assert shops[0]['total_pay'] == 9.43
+
+
+class FakeEngine():
+    """returns one word of OCR data per image, with each of `texts`.
+    """
+
+    def __init__(self, texts):
+        self.texts = texts
+
+    def map_data(self, images, psm=None, whitelist=None):
+        return [[[{'text': t, 'conf': 90.0, 'box': [0, 0, 10, 10]}]] if t else []
+                for t in self.texts]
+
+
+def test_reocr_amounts_drops_currency_glyph(monkeypatch):
+    # the dollar sign read as a 5, as tesseract does with the digit whitelist
+    monkeypatch.setattr(ocr, 'get_engine', lambda: FakeEngine(["59.43", "$1,021", "", "9"]))
+    gray = np.zeros((100, 100), dtype=np.uint8)
+    results = reocr_amounts(gray, [(10, 10, 20, 10)] * 4)
+    assert results == [(9.43, 90.0), (1021.0, 90.0), (None, None), (None, None)]
+
+
+def test_cache_version_depends_on_settings(monkeypatch):
+    version = cache_version()
+    monkeypatch.setattr(receipts, 'OCR_SCALE', None)
+    assert cache_version() != version
+    monkeypatch.setattr(receipts, 'MIN_CONFIDENCE', 50)
+    assert cache_version() != version
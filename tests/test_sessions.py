@@ -0,0 +1,57 @@
+from shipt.sessions import SessionStore
+
+
+def test_flush_writes_changed_keys(backend):
+    sessions = SessionStore(backend)
+    sessions.stage("555", {"a": 1, "b": 2})
+    assert sessions.flush("555")
+    sessions.stage("555", {"a": 1})
+    assert sessions.flush("555")
+    assert backend.sessions["555"] == {"a": 1}
+
+
+def test_failed_flush_is_retried(backend):
+    sessions = SessionStore(backend)
+    sessions.stage("555", {"a": 1, "b": 2})
+    backend.fail_writes = True
+    assert not sessions.flush("555")
+    backend.fail_writes = False
+    assert sessions.flush("555")
+    assert backend.sessions["555"] == {"a": 1, "b": 2}
+
+
+def test_failed_flush_keeps_newer_changes(backend):
+    sessions = SessionStore(backend)
+    sessions.stage("555", {"a": 1, "b": 2})
+    backend.fail_writes = True
+    assert not sessions.flush("555")
+    sessions.stage("555", {"a": 3})
+    backend.fail_writes = False
+    assert sessions.flush("555")
+    assert backend.sessions["555"] == {"a": 3}
+
+
+def test_get_reads_newer_session_from_backend(backend):
+    sessions = SessionStore(backend)
+    sessions.stage("555", {"a": 1})
+    sessions.flush("555")
+    # written by another instance
+    backend.sessions["555"] = {"a": 2}
+    assert sessions.get("555") == {"a": 2}
+
+
+def test_get_keeps_unwritten_changes(backend):
+    sessions = SessionStore(backend)
+    backend.sessions["555"] = {"a": 1, "b": 2}
+    sessions.get("555")
+    sessions.stage("555", {"a": 3})
+    assert sessions.get("555") == {"a": 3}
+
+
+def test_forget_drops_session_and_changes(backend):
+    sessions = SessionStore(backend)
+    sessions.stage("555", {"a": 1})
+    sessions.forget("555").result()
+    assert sessions.flush("555")
+    assert sessions.get("555") is None
+    assert "555" not in backend.sessions
@@ -0,0 +1,83 @@
+import pandas as pd
+import pytest
+
+from shipt.shipt_backend import metro_totals, normalize_metro, shop_stats
+
+SHOPS = pd.DataFrame([
+    {"order_number": "1", "order_total": 100.0, "order_pay": 12.5, "tip": 5.0,
+     "total_pay": 17.5, "is_v1": True},
+    {"order_number": "2", "order_total": 60.0, "order_pay": 7.0, "tip": 0.0,
+     "total_pay": 7.0, "is_v1": False},
+    {"order_number": "3", "order_total": 200.0, "order_pay": 20.0, "tip": 10.0,
+     "total_pay": 30.0, "is_v1": True},
+    {"order_number": "4", "order_total": 80.0, "order_pay": 8.0, "tip": 2.0,
+     "total_pay": 10.0, "is_v1": False},
+])
+
+
+def test_shop_stats_match_per_statistic_queries():
+    # how each statistic was computed before shop_stats, one query at a time
+    v1 = SHOPS[SHOPS["is_v1"] == True]
+    v2 = SHOPS[SHOPS["is_v1"] == False]
+    pay_if_v1 = SHOPS["order_total"] * 0.075 + 5
+    stats = shop_stats(SHOPS)
+    assert (stats["n_v1"], stats["mean_pay_v1"]) == (len(v1), v1["order_pay"].mean())
+    assert (stats["n_v2"], stats["mean_pay_v2"]) == (len(v2), v2["order_pay"].mean())
+    assert stats["likely_v1"] == (len(v1) / len(SHOPS) > 0.75)
+    assert stats["mean_pay_if_v1"] == pytest.approx(pay_if_v1.mean())
+    assert stats["mean_pay_true"] == pytest.approx(SHOPS["order_pay"].mean())
+    assert stats["mean_tip"] == pytest.approx(SHOPS["tip"].mean())
+    assert stats["mean_tip_pct"] == pytest.approx((SHOPS["tip"] / SHOPS["total_pay"]).mean())
+    assert stats["total_pay_difference"] == pytest.approx(
+        pay_if_v1.sum() - SHOPS["order_pay"].sum())
+
+
+def test_shop_stats_empty():
+    stats = shop_stats(pd.DataFrame())
+    assert stats["n_records"] == 0
+    assert stats["mean_pay_true"] is None
+    assert stats["likely_v1"] is None
+
+
+def test_shop_stats_without_v1_column():
+    stats = shop_stats(SHOPS.drop(columns=["is_v1"]))
+    assert stats["n_v1"] == 0
+    assert stats["n_v2"] == 0
+    assert stats["mean_pay_v1"] is None
+    assert stats["mean_pay_true"] == pytest.approx(SHOPS["order_pay"].mean())
+
+
+def test_metro_totals_recover_means():
+    totals = metro_totals(SHOPS)
+    assert totals["n_records"] == 4
+    assert totals["n_v1"] == 2
+    assert totals["sum_order_pay"] / totals["n_order_pay"] == pytest.approx(
+        SHOPS["order_pay"].mean())
+    assert totals["sum_order_pay_v1"] / totals["n_order_pay_v1"] == pytest.approx(16.25)
+    assert totals["sum_tip"] / totals["n_tip"] == pytest.approx(SHOPS["tip"].mean())
+
+
+def test_metro_totals_skip_missing_values():
+    shops = SHOPS.astype({"tip": object})
+    shops.loc[0, "tip"] = ""
+    shops.loc[1, "total_pay"] = 0.0
+    totals = metro_totals(shops)
+    assert totals["n_tip"] == 3
+    # no tip percentage without a tip, or with no total pay
+    assert totals["n_tip_pct"] == 2
+
+
+def test_metro_totals_empty_and_missing_columns():
+    empty = metro_totals(pd.DataFrame())
+    assert empty["n_records"] == 0
+    assert empty["sum_order_pay"] == 0.0
+    totals = metro_totals(SHOPS[["order_number", "order_pay"]])
+    assert totals["n_records"] == 4
+    assert totals["n_v1"] == 0
+    assert totals["n_tip"] == 0
+
+
+def test_normalize_metro():
+    assert normalize_metro(" B. City ") == "b-city"
+    assert normalize_metro("Des Moines, IA") == normalize_metro("des moines ia")
+    assert normalize_metro("...") == "unknown"